@@ -0,0 +1,86 @@
+"""
+Check combine_intervals against the loop it replaced, on random unsafe intervals of a few trains per block. The loop
+compared every interval with the ones kept so far; here it has the two changes of the sweep applied: it does not skip
+an interval after removing one, and the intervals of the excluded agent are left out before combining. The results
+must be equal block for block.
+
+Run from the repository root:
+    python -m benchmarks.combine [-n cases]
+"""
+import random
+import argparse
+
+from generation.interval_generation import combine_intervals
+
+parser = argparse.ArgumentParser(
+                    prog='combine',
+                    description='Compare combine_intervals with the loop it replaced on random intervals')
+parser.add_argument('-n', "--cases", help="(optional) number of random scenarios (default=1000)", default=1000, type=int)
+parser.add_argument("--seed", help="(optional) seed of the random scenarios (default=1)", default=1, type=int)
+
+
+def combine_intervals_loop(intervals, combined, agent):
+    """The loop combine_intervals replaced, iterating over a copy of the kept intervals and without the agent."""
+    excluded = None if agent is None else int(agent)
+    for train in intervals:
+        if train == excluded:
+            continue
+        for n in intervals[train]:
+            if n not in combined:
+                continue
+            for tup in sorted(intervals[train][n]):
+                double = False
+                for x in list(combined[n]):
+                    # If the new (tup) fits in existing (x)
+                    if tup[0] >= x[0] and tup[0] <= x[1] and tup[1] <= x[1] and tup[1] >= x[0]:
+                        double = True
+                    # if the existing (x) fits in the new (tup) -> replace
+                    elif x[0] >= tup[0] and x[0] <= tup[1] and x[1] <= tup[1] and x[1] >= tup[0]:
+                        combined[n].remove(x)
+                if not double:
+                    combined[n].append(tup)
+
+
+def random_scenario(rng: random.Random):
+    """
+    Intervals of a few trains on a few blocks, on a coarse time grid so equal, nested and touching intervals are
+    common. Returns the intervals per train, the blocks to combine and the agent to leave out.
+    """
+    blocks = [f"r-{i}" for i in range(rng.randint(1, 4))]
+    trains = rng.randint(1, 6)
+    intervals = {}
+    for train in range(1, trains + 1):
+        intervals[train] = {}
+        for block in rng.sample(blocks, rng.randint(0, len(blocks))):
+            intervals[train][block] = []
+            for _ in range(rng.randint(1, 4)):
+                start = rng.randint(-2, 20)
+                intervals[train][block].append((start, start + rng.randint(0, 8), rng.choice([0, 60]), train, rng.randint(0, 3)))
+    agent = rng.choice([None, -1, str(rng.randint(1, trains)), rng.randint(1, trains)])
+    # Not every block needs to be combined, e.g. only the blocks of one train in combine_intervals_without_agent
+    combine = rng.sample(blocks, rng.randint(1, len(blocks)))
+    return intervals, combine, agent
+
+
+def run(function, scenarios):
+    results = []
+    for intervals, blocks, agent in scenarios:
+        combined = {n: [] for n in blocks}
+        function(intervals, combined, agent)
+        results.append({n: sorted(combined[n]) for n in blocks})
+    return results
+
+
+def main():
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    scenarios = [random_scenario(rng) for _ in range(args.cases)]
+    expected = run(combine_intervals_loop, scenarios)
+    results = run(combine_intervals, scenarios)
+    for i, (scenario, a, b) in enumerate(zip(scenarios, expected, results)):
+        assert a == b, f"case {i}: combine_intervals gives {b} instead of {a} for {scenario}"
+    print(f"combine_intervals equals the loop on {args.cases} random scenarios")
+
+
+if __name__ == "__main__":
+    main()
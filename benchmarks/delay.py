@@ -0,0 +1,80 @@
+"""
+Time updating the safe interval graph of an agent after a delay of a single train, with DelayUpdate.update_train, and
+compare it with generating the graph of the delayed scenario from scratch, on synthetic corridors of growing size.
+The update should take time in proportion to the blocks of the delayed train, not to the whole scenario.
+
+Run from the repository root:
+    python -m benchmarks.delay [stations:trains ...]
+"""
+import copy
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+from pathlib import Path
+
+from benchmarks.synthetic import corridor_location, corridor_scenario
+from generation.buffer_time import flexibility
+from generation.convert_to_safe_intervals import create_safe_intervals
+from generation.delay_update import DelayUpdate
+from generation.graph import BlockGraph
+from generation.interval_generation import process_scenario
+from generation.signal_sections import convertMovesToBlock
+from generation.util import read_graph
+
+parser = argparse.ArgumentParser(
+                    prog='delay',
+                    description='Time updating the safe interval graph after a delay of one train')
+parser.add_argument("scales", nargs="*", help="Synthetic corridors as stations:trains pairs (default: 5:8 20:60 40:120)")
+parser.add_argument('-d', "--delays", help="(optional) number of delayed trains per corridor (default=10)", default=10, type=int)
+parser.add_argument("--delay", help="(optional) delay of a train in seconds (default=120)", default=120, type=int)
+
+
+def delayed(entry, delay):
+    entry = copy.deepcopy(entry)
+    for movement in entry["movements"]:
+        movement["startTime"] += delay
+        movement["endTime"] += delay
+        for stop in movement.get("stops", []):
+            stop["time"] += delay
+    return entry
+
+
+def main():
+    args = parser.parse_args()
+    scales = [tuple(int(x) for x in scale.split(":")) for scale in args.scales] or [(5, 8), (20, 60), (40, 120)]
+    print(f"{'stations':>8} {'trains':>7} {'update s':>9} {'full s':>9} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        location = Path(directory) / "corridor.json"
+        for stations, trains in scales:
+            with open(location, "w") as f:
+                json.dump(corridor_location(stations), f)
+            data = corridor_scenario(stations, trains)
+            g = read_graph(str(location))
+            g_block = BlockGraph(g)
+            destination = next(iter(g_block.stations.values()))[0]
+            update = DelayUpdate(copy.deepcopy(data), g, g_block, destination, 40.0)
+            rng = random.Random(1)
+            update_seconds = full_seconds = 0.0
+            for _ in range(args.delays):
+                train = rng.randint(1, trains)
+                entry = delayed(update.data["trains"][train - 1], args.delay)
+                start = time.perf_counter()
+                update.update_train(train, entry)
+                update_seconds += time.perf_counter() - start
+
+                start = time.perf_counter()
+                block_intervals, moves_per_agent = process_scenario(update.data, g, g_block, -1)
+                buffer_times, recovery_times = flexibility(block_intervals, convertMovesToBlock(moves_per_agent, g))
+                create_safe_intervals(block_intervals, g_block, buffer_times, recovery_times, destination, 40.0)
+                full_seconds += time.perf_counter() - start
+            update_seconds /= args.delays
+            full_seconds /= args.delays
+            print(f"{stations:>8} {trains:>7} {update_seconds:>9.4f} {full_seconds:>9.4f} {full_seconds / update_seconds:>8.1f}")
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    main()
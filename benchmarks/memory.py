@@ -0,0 +1,105 @@
+"""
+Report the memory used by the track graph and block graph of every location in data/, with the adjacency in edge
+lists and in compact arrays, and the time of a Dijkstra search over the whole block graph in each mode.
+
+Run from the repository root:
+    python -m benchmarks.memory [location ...]
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tracemalloc
+from pathlib import Path
+
+from generation.graph import BlockGraph
+from generation.interval_generation import shortest_paths
+from generation.util import read_graph
+
+DATA_DIRECTORY = Path(__file__).parent.parent / "data"
+
+parser = argparse.ArgumentParser(
+                    prog='memory',
+                    description='Report bytes per node and per edge of the graphs of each location')
+parser.add_argument("locations", nargs="*", help="Location files (default: all locations in data/)")
+parser.add_argument('-n', "--searches", help="(optional) number of Dijkstra searches timed per graph (default=20)", default=20, type=int)
+parser.add_argument("--agent_speed", help="(optional) speed of the agent in the Dijkstra searches (default=40)", default=40, type=float)
+
+
+def location_files():
+    """All location files in data/, recognised by their track parts."""
+    for file in sorted(DATA_DIRECTORY.glob("**/*.json")):
+        with open(file) as f:
+            data = json.load(f)
+        if isinstance(data, dict) and "trackParts" in data:
+            yield file
+
+
+def attribute_values(obj):
+    if hasattr(obj, "__dict__"):
+        yield obj.__dict__
+        yield from obj.__dict__.values()
+    for cls in type(obj).__mro__:
+        for slot in cls.__dict__.get("__slots__", ()):
+            if hasattr(obj, slot):
+                yield getattr(obj, slot)
+
+
+def shallow_size(obj):
+    """Size of an object together with the containers it owns, but not the graph elements these refer to."""
+    return sys.getsizeof(obj) + sum(sys.getsizeof(value) for value in attribute_values(obj)
+                                    if isinstance(value, (list, dict, set, tuple)))
+
+
+def graph_size(g):
+    node_bytes = sum(shallow_size(node) for node in g.nodes.values())
+    edge_bytes = sum(shallow_size(edge) for edge in g.edges)
+    if g.csr is not None:
+        node_bytes += g.csr.nbytes()
+    return node_bytes, edge_bytes
+
+
+def dijkstra_seconds(graph, searches, agent_speed):
+    """Mean time of a search over the whole graph, from nodes spread over the graph."""
+    nodes = list(graph.nodes.values())
+    if not nodes:
+        return 0.0
+    starts = nodes[::max(1, len(nodes) // searches)][:searches]
+    start = time.perf_counter()
+    for node in starts:
+        shortest_paths(node, agent_velocity=agent_speed)
+    return (time.perf_counter() - start) / len(starts)
+
+
+def measure(location, compact, searches, agent_speed):
+    tracemalloc.start()
+    g = read_graph(str(location), compact)
+    g_block = BlockGraph(g, compact)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rows = []
+    for name, graph in (("track", g), ("block", g_block)):
+        node_bytes, edge_bytes = graph_size(graph)
+        rows.append((name, len(graph.nodes), len(graph.edges), node_bytes / max(1, len(graph.nodes)),
+                     edge_bytes / max(1, len(graph.edges)), dijkstra_seconds(graph, searches, agent_speed)))
+    return rows, peak
+
+
+def main():
+    args = parser.parse_args()
+    locations = [Path(l) for l in args.locations] or list(location_files())
+    print(f"{'location':<55} {'mode':<8} {'graph':<6} {'nodes':>7} {'edges':>7} {'B/node':>8} {'B/edge':>8} "
+          f"{'peak MB':>8} {'dijkstra ms':>12}")
+    for location in locations:
+        for mode, compact in (("lists", False), ("compact", True)):
+            rows, peak = measure(location, compact, args.searches, args.agent_speed)
+            for name, nodes, edges, per_node, per_edge, seconds in rows:
+                print(f"{os.path.relpath(location):<55} {mode:<8} {name:<6} {nodes:>7} {edges:>7} {per_node:>8.0f} "
+                      f"{per_edge:>8.0f} {peak / 2 ** 20:>8.2f} {seconds * 1000:>12.2f}")
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    main()
@@ -0,0 +1,53 @@
+"""
+Time merging the unsafe intervals of a block on synthetic lists of growing size with merge_intervals, which should
+take a constant time per interval.
+
+Run from the repository root:
+    python -m benchmarks.merge [size ...]
+"""
+import time
+import random
+import argparse
+
+from generation.interval_generation import merge_intervals
+
+parser = argparse.ArgumentParser(
+                    prog='merge',
+                    description='Time merging synthetic interval lists of growing size')
+parser.add_argument("sizes", nargs="*", type=int, help="Numbers of intervals (default: 10000 100000 1000000)")
+parser.add_argument('-r', "--repeat", help="(optional) number of timed runs per size, the fastest counts (default=3)", default=3, type=int)
+
+
+def synthetic_intervals(size, seed=1):
+    """Sorted intervals of about a minute, with a gap after about half of them, like the occupations of a busy block."""
+    rng = random.Random(seed)
+    intervals = []
+    start = 0.0
+    for _ in range(size):
+        length = rng.uniform(30, 90)
+        intervals.append((start, start + length, rng.choice([0, 60]), rng.randint(1, 500), rng.uniform(0, 10)))
+        start += length * rng.uniform(0.5, 1.5)
+    return intervals
+
+
+def fastest(function, repeat):
+    seconds = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds = min(seconds, time.perf_counter() - start)
+    return seconds, result
+
+
+def main():
+    args = parser.parse_args()
+    sizes = args.sizes or [10 ** 4, 10 ** 5, 10 ** 6]
+    print(f"{'intervals':>10} {'merged':>10} {'seconds':>9} {'ns/interval':>12}")
+    for size in sizes:
+        intervals = synthetic_intervals(size)
+        seconds, merged = fastest(lambda: merge_intervals(intervals), args.repeat)
+        print(f"{size:>10} {len(merged):>10} {seconds:>9.4f} {seconds / size * 1e9:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
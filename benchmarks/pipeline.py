@@ -0,0 +1,195 @@
+"""
+Time every stage of the generation on each location/scenario pair in data/ and on synthetic corridors of growing size,
+and compare the wall time and peak memory of each stage with a stored baseline.
+
+Run from the repository root:
+    python -m benchmarks.pipeline --save-baseline     # record the baseline on this machine
+    python -m benchmarks.pipeline                     # exits with 1 when a stage got slower or uses more memory
+"""
+import gc
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+from benchmarks.memory import DATA_DIRECTORY
+from benchmarks.synthetic import corridor_location, corridor_scenario
+from generation.buffer_time import flexibility
+from generation.convert_to_safe_intervals import create_safe_intervals, write_intervals_to_file
+from generation.graph import BlockGraph
+from generation.interval_generation import process_scenario
+from generation.signal_sections import convertMovesToBlock
+from generation.util import read_graph
+
+BASELINE = Path(__file__).parent / "baselines" / "pipeline.json"
+STAGES = ["read_graph", "BlockGraph", "process_scenario", "convertMovesToBlock", "flexibility",
+          "create_safe_intervals", "write_intervals_to_file"]
+# (stations, trains) of the synthetic corridors
+SCALES = [(5, 8), (20, 60), (40, 120)]
+
+parser = argparse.ArgumentParser(
+                    prog='pipeline',
+                    description='Benchmark the stages of the generation and compare them with a baseline')
+parser.add_argument('-o', "--output", help="(optional) file to write the results to (default=pipeline_results.json)", default="pipeline_results.json")
+parser.add_argument('-b', "--baseline", help="(optional) baseline to compare with (default=benchmarks/baselines/pipeline.json)", default=BASELINE, type=Path)
+parser.add_argument("--save-baseline", help="store the results as the new baseline instead of comparing", action="store_true")
+parser.add_argument('-r', "--repeat", help="(optional) number of timed runs per case, the fastest counts (default=3)", default=3, type=int)
+parser.add_argument("--time-tolerance", help="(optional) allowed relative slowdown of a stage (default=0.25)", default=0.25, type=float)
+parser.add_argument("--memory-tolerance", help="(optional) allowed relative increase of the peak memory of a stage (default=0.10)", default=0.10, type=float)
+parser.add_argument("--min-seconds", help="(optional) stages faster than this in the baseline are not compared on time (default=0.05)", default=0.05, type=float)
+parser.add_argument("--scales", help="(optional) synthetic corridors as stations:trains pairs, e.g. 5:8 20:60", nargs="*")
+parser.add_argument("--no-bundled", help="skip the locations in data/", action="store_true")
+parser.add_argument("--no-synthetic", help="skip the synthetic corridors", action="store_true")
+
+
+def bundled_cases():
+    """Every location in a directory of data/ paired with every scenario in the same directory."""
+    for directory in sorted(p for p in DATA_DIRECTORY.iterdir() if p.is_dir()):
+        locations, scenarios = [], []
+        for file in sorted(directory.glob("*.json")):
+            with open(file) as f:
+                data = json.load(f)
+            if isinstance(data, dict) and "trackParts" in data:
+                locations.append(file)
+            elif isinstance(data, dict) and "trains" in data:
+                scenarios.append(file)
+        for location in locations:
+            for scenario in scenarios:
+                yield f"{directory.name}/{location.stem}/{scenario.stem}", location, scenario
+
+
+def synthetic_cases(scales, directory):
+    for stations, trains in scales:
+        location = Path(directory) / f"corridor_{stations}.json"
+        scenario = Path(directory) / f"corridor_{stations}_{trains}.json"
+        with open(location, "w") as f:
+            json.dump(corridor_location(stations), f)
+        with open(scenario, "w") as f:
+            json.dump(corridor_scenario(stations, trains), f)
+        yield f"synthetic/corridor_{stations}/trains_{trains}", location, scenario
+
+
+def run_stages(location, scenario, output, measure):
+    """Run the pipeline once, measure(stage, function) runs a stage and records its cost."""
+    g = measure("read_graph", lambda: read_graph(str(location)))
+    g_block = measure("BlockGraph", lambda: BlockGraph(g))
+    with open(scenario) as f:
+        data = json.load(f)
+    block_intervals, moves_per_agent = measure("process_scenario", lambda: process_scenario(data, g, g_block, -1))
+    block_routes = measure("convertMovesToBlock", lambda: convertMovesToBlock(moves_per_agent, g))
+    buffer_times, recovery_times = measure("flexibility", lambda: flexibility(block_intervals, block_routes))
+    # The safe intervals are generated for an agent heading to the first platform
+    destination = next(iter(g_block.stations.values()))[0] if g_block.stations else next(iter(g_block.nodes))
+    safe_intervals, _, atfs, _, indices_to_states = measure("create_safe_intervals", lambda: create_safe_intervals(
+        block_intervals, g_block, buffer_times, recovery_times, destination, 40.0))
+    measure("write_intervals_to_file", lambda: write_intervals_to_file(output, safe_intervals, atfs, indices_to_states))
+
+
+def benchmark(location, scenario, output, repeat):
+    """Fastest wall time of each stage over repeat runs, and the peak memory of each stage in one traced run."""
+    seconds = {}
+    peaks = {}
+
+    def timed(stage, function):
+        start = time.perf_counter()
+        result = function()
+        seconds[stage] = min(seconds.get(stage, float("inf")), time.perf_counter() - start)
+        return result
+
+    def traced(stage, function):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        result = function()
+        peaks[stage] = tracemalloc.get_traced_memory()[1] - before
+        return result
+
+    results = {}
+    # Stages before a failing one are still reported
+    try:
+        for _ in range(repeat):
+            gc.collect()
+            run_stages(location, scenario, output, timed)
+    except Exception as e:
+        results["error"] = f"{type(e).__name__}: {e}"
+    tracemalloc.start()
+    try:
+        run_stages(location, scenario, output, traced)
+    except Exception:
+        pass
+    finally:
+        tracemalloc.stop()
+    for stage in STAGES:
+        if stage in seconds:
+            results[stage] = {"seconds": round(seconds[stage], 4), "peak_mb": round(peaks.get(stage, 0) / 2 ** 20, 3)}
+    return results
+
+
+def compare(results, baseline, args):
+    """Regressions of results relative to baseline, as printable lines."""
+    regressions = []
+    for case, stages in results.items():
+        for stage in STAGES:
+            if stage not in stages or stage not in baseline.get(case, {}):
+                continue
+            old, new = baseline[case][stage], stages[stage]
+            if old["seconds"] >= args.min_seconds and new["seconds"] > old["seconds"] * (1 + args.time_tolerance):
+                regressions.append(f"{case} {stage}: {old['seconds']:.3f} s -> {new['seconds']:.3f} s")
+            if old["peak_mb"] >= 1 and new["peak_mb"] > old["peak_mb"] * (1 + args.memory_tolerance):
+                regressions.append(f"{case} {stage}: {old['peak_mb']:.1f} MB -> {new['peak_mb']:.1f} MB")
+    return regressions
+
+
+def main():
+    args = parser.parse_args()
+    scales = [tuple(int(x) for x in scale.split(":")) for scale in args.scales] if args.scales else SCALES
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        cases = []
+        if not args.no_bundled:
+            cases.extend(bundled_cases())
+        if not args.no_synthetic:
+            cases.extend(synthetic_cases(scales, directory))
+        print(f"{'case':<70} {'stage':<24} {'seconds':>9} {'peak MB':>9}")
+        for case, location, scenario in cases:
+            results[case] = benchmark(location, scenario, Path(directory) / "intervals.txt", args.repeat)
+            for stage in STAGES:
+                if stage in results[case]:
+                    print(f"{case:<70} {stage:<24} {results[case][stage]['seconds']:>9.4f} {results[case][stage]['peak_mb']:>9.2f}")
+            if "error" in results[case]:
+                print(f"{case:<70} {'failed':<24} {results[case]['error']}")
+
+    report = {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "cases": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline {args.baseline}")
+        return 0
+    if not args.baseline.exists():
+        print(f"No baseline {args.baseline}, record one with --save-baseline")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline["cases"], args)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    print(f"{len(regressions)} regressions compared to {args.baseline}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    sys.exit(main())
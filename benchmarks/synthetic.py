@@ -0,0 +1,109 @@
+"""
+Synthetic layouts and scenarios of any size, to benchmark the generation beyond the bundled locations.
+
+A layout is a corridor of stations, each station is a pair of platform tracks between two switches and the stations are
+connected by line tracks. Both ends of the corridor are bumpers where trains can turn around, so every platform can be
+reached from every other platform.
+"""
+import random
+
+TRAIN_TYPE = {"name": "SNG", "length": 100, "speed": 100}
+
+
+def corridor_location(stations, line_length=3000, platform_length=400):
+    track_parts = []
+    signals = []
+    platforms = []
+
+    def add_track(name, track_type, length, station_platform=False):
+        track_parts.append({
+            "id": len(track_parts) + 1,
+            "name": name,
+            "type": track_type,
+            "length": length,
+            "aSide": [],
+            "bSide": [],
+            "stationPlatform": station_platform,
+            "sawMovementAllowed": track_type == "Bumper",
+            "parkingAllowed": False,
+            "wisselhoek": "12" if track_type == "Switch" else None,
+        })
+        return track_parts[-1]
+
+    def connect(a, b):
+        a["bSide"].append(b["id"])
+        b["aSide"].append(a["id"])
+
+    def add_signals(name, track):
+        signals.append({"name": f"{name}a", "side": "A", "track": track["id"]})
+        signals.append({"name": f"{name}b", "side": "B", "track": track["id"]})
+
+    previous = add_track("t-L0-", "RailRoad", line_length)
+    connect(add_track("t-BW-", "Bumper", 200), previous)
+    add_signals("S0", previous)
+    for i in range(1, stations + 1):
+        west = add_track(f"s-W{i}-", "Switch", 50)
+        station_platforms = [add_track(f"t-P{i}x{j}-", "RailRoad", platform_length, True) for j in (1, 2)]
+        east = add_track(f"s-E{i}-", "Switch", 50)
+        line = add_track(f"t-L{i}-", "RailRoad", line_length)
+        connect(previous, west)
+        for j, platform in enumerate(station_platforms):
+            connect(west, platform)
+            connect(platform, east)
+            add_signals(f"S{i}p{j}", platform)
+            platforms.append({"stationName": f"st{i}", "platform": str(j + 1), "trackId": platform["id"]})
+        connect(east, line)
+        add_signals(f"S{i}l", line)
+        previous = line
+    connect(previous, add_track("t-BE-", "Bumper", 200))
+
+    return {
+        "trackParts": track_parts,
+        "signals": signals,
+        "stations": platforms,
+        "distanceMarkers": {},
+        "facilities": [],
+        "taskTypes": [],
+        "movementConstant": 0,
+        "movementTrackCoefficient": 0,
+        "movementSwitchCoefficient": 0,
+        "distanceEntries": [],
+    }
+
+
+def corridor_scenario(stations, trains, seed=1):
+    """Trains running between two random stations of a corridor_location, stopping at about half of the stations in between."""
+    rng = random.Random(seed)
+    scenario_trains = []
+    for train_number in range(1, trains + 1):
+        start, end = rng.sample(range(1, stations + 1), 2)
+        step = 1 if end > start else -1
+        start_time = rng.randint(0, 40000)
+        time = start_time
+        stops = []
+        for station in range(start + step, end, step):
+            time += 300
+            if rng.random() < 0.5:
+                stops.append({"location": f"ST{station}|{rng.randint(1, 2)}", "time": time + 60})
+        scenario_trains.append({
+            "trainNumber": train_number,
+            "trainUnitTypes": [TRAIN_TYPE["name"]],
+            "movements": [{
+                "startLocation": f"ST{start}|{rng.randint(1, 2)}",
+                "startTime": start_time,
+                "endTime": time + 300,
+                "endLocation": f"ST{end}|{rng.randint(1, 2)}",
+                "stops": stops,
+            }],
+        })
+    return {
+        "types": [TRAIN_TYPE],
+        "trains": scenario_trains,
+        "walkingSpeed": 1,
+        "headwayFollowing": 60,
+        "headwayCrossing": 60,
+        "releaseTime": 20,
+        "setupTime": 20,
+        "sightReactionTime": 10,
+        "minimumStopTime": 60,
+    }
@@ -1,77 +1,211 @@
+import os
 import pickle
+import hashlib
 from logging import getLogger
 
-import generation
+import generation.graph
 
 logger = getLogger('__main__.' + __name__)
 
-class GraphPickler(pickle.Pickler):
-    def persistent_id(self, obj):
-        if type(obj) is generation.graph.BlockEdge:
-            return ("BlockEdge", {
-                "id": obj.id,
-                "length": obj.length,
-                "direction": obj.direction,
-                "from_node": obj.from_node.name,
-                "to_node": obj.to_node.name,
-                "trackNodes": [tn.name for tn in obj.trackNodes],
-            })
-        if type(obj) is generation.graph.BlockNode:
-            return ("BlockNode", {
-                "name": obj.name,
-                "incoming": [inc.id for inc in obj.incoming],
-                "outgoing": [out.id for out in obj.outgoing]
-            })
+# Increase whenever the cached layout below or the way the graphs are constructed changes
+CACHE_VERSION = 3
+CACHE_DIRECTORY = ".graph_cache"
+
+
+def location_hash(file_path):
+    """Hash of the content of the location file, together with the cache version this is the key of the cache."""
+    digest = hashlib.sha256(f"v{CACHE_VERSION}".encode())
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_path(file_path, cache_dir=None, suffix=""):
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(file_path)), CACHE_DIRECTORY)
+    return os.path.join(cache_dir, f"{location_hash(file_path)}{suffix}.pkl")
+
+
+def serialize_track_graph(g):
+    """Plain (picklable) representation of the track graph, nodes and edges are referenced by their index."""
+    node_index = {node.name: i for i, node in enumerate(g.nodes.values())}
+    edge_index = {id(edge): i for i, edge in enumerate(g.edges)}
+    return {
+        "file_name": g.file_name,
+        "nodes": [(
+            node.name,
+            node.type,
+            node.stationPlatform,
+            node.canReverse,
+            [node_index[n.name] for n in node.associated],
+            [node_index[n.name] for n in node.opposites],
+        ) for node in g.nodes.values()],
+        "edges": [(
+            node_index[e.from_node.name],
+            node_index[e.to_node.name],
+            e.length,
+            e.max_speed,
+            [edge_index[id(x)] for x in e.associated],
+            [edge_index[id(x)] for x in e.opposites],
+        ) for e in g.edges],
+        "signals": [(signal.id, node_index[signal.track.name]) for signal in g.signals],
+        "stations": dict(g.stations),
+        "distance_markers": dict(g.distance_markers),
+        "track_parts": [tuple(track) for track in g.track_parts.values()],
+    }
+
+
+def serialize_block_graph(g_block, g):
+    track_index = {name: i for i, name in enumerate(g.nodes)}
+    block_index = {name: i for i, name in enumerate(g_block.nodes)}
+    return {
+        "nodes": list(g_block.nodes),
+        # Block nodes are registered on the track node of their signal
+        "signal_nodes": [(track_index[signal.track.name], block_index[f"r-{signal.id}"]) for signal in g.signals],
+        "edges": [(
+            block_index[e.from_node.name],
+            block_index[e.to_node.name],
+            e.length,
+            [track_index[tn.name] for tn in e.tn],
+            e.direction,
+            e.max_speed,
+        ) for e in g_block.edges],
+        "stations": dict(g_block.stations),
+    }
+
+
+def deserialize_track_graph(data):
+    from generation.util import TrackConnections
+
+    g = generation.graph.TrackGraph(data["file_name"])
+    nodes = [g.add_node(generation.graph.TrackNode(name, track_type)) for name, track_type, *_ in data["nodes"]]
+    for node, (_, _, station_platform, can_reverse, associated, opposites) in zip(nodes, data["nodes"]):
+        node.stationPlatform = station_platform
+        node.canReverse = can_reverse
+        node.associated = [nodes[i] for i in associated]
+        node.opposites = [nodes[i] for i in opposites]
+    edges = []
+    for f, t, length, max_speed, _, _ in data["edges"]:
+        e = generation.graph.TrackEdge(nodes[f], nodes[t], length)
+        e.max_speed = max_speed
+        edges.append(g.add_edge(e))
+    for e, (_, _, _, _, associated, opposites) in zip(edges, data["edges"]):
+        e.associated = [edges[i] for i in associated]
+        e.opposites = [edges[i] for i in opposites]
+    for signal_id, node in data["signals"]:
+        g.add_signal(generation.graph.Signal(signal_id, nodes[node]))
+    g.stations = dict(data["stations"])
+    g.distance_markers = dict(data["distance_markers"])
+    g.track_parts = {track[0]: TrackConnections(*track) for track in data["track_parts"]}
+    return g
+
+
+def deserialize_block_graph(data, g):
+    track_nodes = list(g.nodes.values())
+    g_block = generation.graph.BlockGraph.__new__(generation.graph.BlockGraph)
+    generation.graph.Graph.__init__(g_block)
+    nodes = [g_block.add_node(generation.graph.BlockNode(name)) for name in data["nodes"]]
+    for track, block in data["signal_nodes"]:
+        track_nodes[track].blk.append(nodes[block])
+    for f, t, length, route, direction, max_speed in data["edges"]:
+        g_block.add_edge(generation.graph.BlockEdge(nodes[f], nodes[t], length, [track_nodes[i] for i in route], direction, max_speed))
+    g_block.stations = dict(data["stations"])
+    return g_block
+
+
+def dump_graphs(filename, g, g_block=None):
+    dump(filename, {
+        "version": CACHE_VERSION,
+        "track": serialize_track_graph(g),
+        "block": serialize_block_graph(g_block, g) if g_block is not None else None,
+    })
+
+
+def dump(filename, data):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    # Write to a temporary file first, so concurrent runs never read a half written cache
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_filename, "wb") as f:
+        pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_filename, filename)
+
+
+def dump_route_table(filename, routes):
+    dump(filename, {
+        "version": CACHE_VERSION,
+        "edges": len(routes.g.edges),
+        "travel_times": routes.travel_times,
+        "paths": routes.paths,
+    })
+
+
+def load_route_table(g, filename):
+    """Route table of g persisted in filename, routes computed later on are added to the same file."""
+    from generation.route_table import RouteTable
+
+    routes = RouteTable(g, filename)
+    data = load_cache(filename)
+    # The routes refer to edges by index, which only holds for the graph the table was built on
+    if data is not None and data["edges"] == len(g.edges):
+        logger.info(f"Using cached route table {filename} with {len(data['paths'])} routes")
+        routes.travel_times.update(data["travel_times"])
+        routes.paths.update(data["paths"])
+    return routes
+
+
+def load_cache(filename):
+    if not os.path.exists(filename):
         return None
+    try:
+        with open(filename, "rb") as f:
+            data = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError) as e:
+        logger.warning(f"Ignoring unreadable graph cache {filename}: {e}")
+        return None
+    if not isinstance(data, dict) or data.get("version") != CACHE_VERSION:
+        logger.info(f"Ignoring graph cache {filename} of an older version")
+        return None
+    return data
+
+
+def cached_graphs(file, cache_dir=None, compact=False, processes=1):
+    """
+    Read the track graph and block graph of a location file, using the cache when the file content was seen before.
+    On a miss both graphs are constructed and written to the cache.
+    """
+    from generation.util import read_graph, location_path
+
+    file_path = location_path(file)
+    filename = cache_path(file_path, cache_dir)
+    data = load_cache(filename)
+    if data is not None and data["block"] is not None:
+        logger.info(f"Using cached graphs {filename}")
+        g = deserialize_track_graph(data["track"])
+        g.file_name = file
+        g_block = deserialize_block_graph(data["block"], g)
+    else:
+        g = read_graph(file)
+        g_block = generation.graph.BlockGraph(g, processes=processes)
+        dump_graphs(filename, g, g_block)
+    g.routes = load_route_table(g, cache_path(file_path, cache_dir, ".routes"))
+    if compact:
+        g.compact()
+        g_block.compact()
+    return g, g_block
+
+
+def cached_block_graph(g, cache_dir=None, processes=1):
+    """Block graph of an already read track graph, the track graph must be read from the same location file."""
+    from generation.util import location_path
 
-class GraphUnpickler(pickle.Unpickler):
-    def __init__(self, file, g):
-        super().__init__(file)
-        self.g = g
-
-
-    def persistent_load(self, pid):
-        type_tag, obj = pid
-        if type_tag == "BlockEdge":
-            f = obj["from_node"]
-            t = obj["to_node"]
-            length = obj["length"]
-            track_nodes = [self.g.nodes[tn] for tn in obj["trackNodes"]]
-            direction = obj["direction"]
-            edge = generation.graph.BlockEdge(f, t, length, [], direction)
-            edge.id = obj["id"]
-            edge.trackNodes = track_nodes
-
-            for node in track_nodes:
-                if edge.id not in {e.id for e in node.blocks}:
-                    node.blocks.append(edge)
-
-            return edge
-        if type_tag == "BlockNode":
-            name = obj["name"]
-            node = generation.graph.BlockNode(name)
-            return node
-        raise pickle.UnpicklingError("Can't unpickle this shit")
-
-def fix_edge(g_block, edge):
-    edge.from_node = g_block.nodes[edge.from_node]
-    edge.from_node.outgoing.append(edge)
-    edge.to_node = g_block.nodes[edge.to_node]
-    edge.to_node.incoming.append(edge)
-
-
-def unpickleGraph(filename, g):
-    with open(filename, "rb") as f:
-        unpickler = GraphUnpickler(f, g)
-        g_block = unpickler.load()
-    for edge in g_block.edges:
-        fix_edge(g_block, edge)
-
-    signal_id_to_signal = {signal.id: signal for signal in g.signals}
-
-    for node_name, node in g_block.nodes.items():
-        signal_name = node_name[2:]
-        signal = signal_id_to_signal[signal_name]
-        signal.track.blocks.append(node)
-
-    return g_block
\ No newline at end of file
+    file_path = location_path(g.file_name)
+    filename = cache_path(file_path, cache_dir)
+    g.routes = load_route_table(g, cache_path(file_path, cache_dir, ".routes"))
+    data = load_cache(filename)
+    if data is not None and data["block"] is not None and [n[0] for n in data["track"]["nodes"]] == list(g.nodes):
+        logger.info(f"Using cached block graph {filename}")
+        return deserialize_block_graph(data["block"], g)
+    g_block = generation.graph.BlockGraph(g, processes=processes)
+    dump_graphs(filename, g, g_block)
+    return g_block
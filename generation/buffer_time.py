@@ -1,5 +1,7 @@
 from logging import getLogger
 
+from generation.instrumentation import profiled
+
 logger = getLogger('__main__.' + __name__)
 
 # TODO maybe should use smarter form off search, as list is most likely sorted on agent id right? or maybe it does not have to...
@@ -16,6 +18,7 @@ def get_single_buffer_time(intervals, agent):
             break
     return float("inf"), recovery_time
 
+@profiled("flexibility")
 def flexibility(block_intervals, block_routes, max_buffer=float("inf"), use_recovery_time=True):
 
     buffer_times = {}
@@ -1,174 +1,251 @@
+from bisect import bisect_left, bisect_right
 from logging import getLogger
 
 logger = getLogger('__main__.' + __name__)
 
 from generation.interval_generation import calculate_heuristic
+from generation.instrumentation import profiled, profiler
+from generation.trace import get_tracer
 
+tracer = get_tracer("safe_intervals")
 
+
+@profiled("create_safe_intervals")
 def create_safe_intervals(intervals, g, buffer_times, recovery_times, destination, agent_speed=15, print_intervals=False):
     errors = []
     safe_node_intervals = {n: [] for n in g.nodes}
     safe_edge_intervals = {e.get_identifier(): [] for e in g.edges}
     arrival_time_functions = []
-    safe_edge_node_references = {e.get_identifier(): [] for e in g.edges}
-    state_indices = {n: {} for n in g.nodes} | {e.get_identifier(): {} for e in g.edges}# save the index per node and also the start of each interval
-    edge_durations = {n: {} for n in g.nodes}
-    indices_to_states = {}
-    index = 0
+    too_short = 0
 
     heuristic = calculate_heuristic(g, g.nodes[destination], agent_speed)
     # Create safe intervals from the unsafe node intervals
-    # Also store the state indices
     for node in g.nodes:
-        current = 0
-        train_before = 0
-        duration = 0
-        # Make sure they are ordered in chronological order
-        intervals[node].sort()
-        # Each tuple is (start, end, duration, train)
-        for start, end, dur, train, _ in intervals[node]:
-            if current > start:
-                interval = (current, start, train_before, train, 0, 0)
-                train_before = train
-                logger.error(f"INTERVAL ERROR safe node interval {interval} on node {node} has later end than start.")
-            elif current == start:
-                # Don't add safe intervals like (0,0), but do update for the next interval
-                logger.error(f"INTERVAL ERROR current == end.")
-                train_before = train
-                current = end
-            else:
-                interval = (current, start, train_before, train, 0, 0)
-                safe_node_intervals[node].append(interval)
-                train_before = train
-                # Dictionary with node keys, each entry has a dictionary with interval keys and then the index value
-                state_indices[node][str(interval)] = index
-                indices_to_states[index] = node
-                duration = dur
-                edge_durations[node][str(interval)] = duration
-                index += 1
-                current = end
-        if current < g.global_end_time:
-            last_interval = (current, g.global_end_time, train_before, 0, 0, 0)
-            safe_node_intervals[node].append(last_interval)
-            state_indices[node][str(last_interval)] = index
-            indices_to_states[index] = node
-            edge_durations[node][str(last_interval)] = duration
-            index += 1
-
+        safe_node_intervals[node] = node_safe_intervals(node, intervals[node], g.global_end_time)
     for edge in g.edges:
         node = edge.get_identifier()
-        current = 0
-        train_before = 0
-        dur_before = 0
-        # Make sure they are ordered in chronological order
-        intervals[node].sort()
-        # Each tuple is (start, end, duration)
-        for start, end, dur, train, _ in intervals[node]:
-            if current > start:
-                interval = (current, start, train_before, train, dur_before, end - start)
-                train_before = train
-                dur_before = end - start
-                logger.info(f"INTERVAL ERROR safe node interval {interval} on node {node} has later end than start.")
-            elif current == start:
-                # Don't add safe intervals like (0,0), but do update for the next interval
-                logger.error(f"INTERVAL ERROR current == end.")
-                train_before = train
-                dur_before = end - start
-                current = end
-            else:
-                interval = (current, start, train_before, train, dur_before, end - start)
-                safe_edge_intervals[node].append(interval)
-                train_before = train
-                dur_before = end - start
-                # Dictionary with node keys, each entry has a dictionary with interval keys and then the index value
-                state_indices[node][str(interval)] = index
-                index += 1
-                current = end
-        if current < g.global_end_time:
-            last_interval = (current, g.global_end_time, train_before, 0, dur_before, 0)
-            safe_edge_intervals[node].append(last_interval)
-            state_indices[node][str(last_interval)] = index
-            index += 1
-
-    ## log safe node intervals
-    for node in safe_node_intervals:
-        logger.info(f"Safe intervals on node {node}")
-        for interval in safe_node_intervals[node]:
-            logger.info(f"    Interval {interval} with index {state_indices[node][str(interval)]}")
-    # Assign the safe edge intervals
+        safe_edge_intervals[node] = edge_safe_intervals(node, intervals[node], g.global_end_time)
 
+    first_state, indices_to_states = number_states(safe_node_intervals, safe_edge_intervals)
 
+    if tracer.enabled:
+        for node in safe_node_intervals:
+            for state, interval in enumerate(safe_node_intervals[node], start=first_state[node]):
+                tracer.emit("safe_interval", node=node, state=state, interval=interval)
+    # Assign the safe edge intervals
+    bounds = {block: interval_bounds(safe) for block, safe in (safe_node_intervals | safe_edge_intervals).items()}
     for node in safe_node_intervals:
-        # Interval is the safe interval on the from node: (start-time, end-time)
-        for from_interval in safe_node_intervals[node]:
-            for o in g.nodes[node].outgoing:
-                from_index = state_indices[node][str(from_interval)]
-                to_index = -1
-                for edge_interval in safe_edge_intervals[o.get_identifier()]:
-                    # The safe interval on the to node (start-time, end-time)
-                    for to_interval in safe_node_intervals[o.to_node.name]:
-                        # If there is some overlap between the intervals, then map them together
-                        if to_interval[0] <= from_interval[1] and to_interval[1] >= from_interval[0]:
-                            to_index = state_indices[o.to_node.name][str(to_interval)]
-                            # zeta: start of u interval, so the interval is same as from node
-                            zeta = from_interval[0]
-                            # alpha: start of safe interval, without wait time, it will be the same as zeta
-                            alpha = max(edge_interval[0], from_interval[0], to_interval[0] - o.length / agent_speed)
-                            # beta: end of safe interval on u
-                            beta = min(edge_interval[1], from_interval[1], to_interval[1] - o.length / agent_speed)
-
-                            # TODO: check why the alpha is what it is, from that interval we select the train_before/after.
-                            #  It's most likely the edge (maybe always?)
-                            train_before = edge_interval[2]
-                            train_after = edge_interval[3]
-
-                            buffer_after = 0
-                            crt_a = 0
-                            if train_after != 0 and o.get_identifier() in buffer_times[train_after]:
-                                buffer_after = buffer_times[train_after][o.get_identifier()]
-                                crt_a = recovery_times[train_after][o.get_identifier()]
-                            elif train_after != 0 and print_intervals:
-                                logger.error(f"ERROR - Buffer time not found while it should have one for train {train_after} "
-                                      f"at {o.get_identifier()}")
-
-                            crt_b = 0
-                            if train_before != 0 and o.get_identifier() in recovery_times[train_before]:
-                                crt_b = recovery_times[train_before][o.get_identifier()]
-                            elif train_before != 0 and print_intervals:
-                                logger.error(f"ERROR - Recovery time not found while it should have one for train {train_before} "
-                                      f"at {o.get_identifier()}")
-
-                            h = heuristic[o.to_node.name]
-
-                            # If the interval is too short to make the move, don't include it.
-                            if beta > alpha:
-                                arrival_time_functions.append((
-                                    from_index,
-                                    to_index,
-                                    zeta,
-                                    alpha,
-                                    beta,
-                                    o.length / agent_speed, # delta: length of the edge or in case of A-B edge the time to walk to the other side
-                                    train_before,
-                                    crt_b,
-                                    train_after,
-                                    buffer_after,
-                                    crt_a,
-                                    h
-                                ))
-                                safe_edge_node_references[o.get_identifier()].append(((node, o.to_node.name), from_interval, to_interval, arrival_time_functions[-1]))
-                            else:
-                                logger.debug(f"--------------------\nFound interval too short\nFrom: {node} to {o.to_node.name}\nf:{from_interval}, t:{to_interval}, e:{edge_interval}\nAlpha: {alpha}, Beta: {beta}")
-                    if to_index < 0:
-                        # If this is an opposite edge which cannot be connected due to node occupied it is okay that is not found
-                        # This is true if this edge interval does not happen on the path of any agent
-                        # logger.info(f"INFO - NOT FOUND an interval for edge <{o.from_node.name},{o.to_node.name}> interval on from node {from_interval} (state {from_index}) and intervals on to node are {safe_node_intervals[o.to_node.name]}")
-                        pass
-    ### To log edge intervals
-    for e in safe_edge_node_references:
-        for data in safe_edge_node_references[e]:
-            atf = data[3]
-            logger.info(f"Edge has interval from {data[0][0]} state {atf[0]} {data[1]} to {data[0][1]} state {atf[1]} {data[2]} with zeta {atf[2]}, alpha {atf[3]}, beta {atf[4]}, delta {atf[5]}, train_before {atf[6]} and train_after {atf[7]}.")
-    for node in safe_node_intervals:
-        logger.info(f"{node} safe intervals: {[str(x) for x in safe_node_intervals[node]]}")
+        atfs, node_too_short = node_atfs(g, node, safe_node_intervals, safe_edge_intervals, bounds, first_state,
+                                         buffer_times, recovery_times, heuristic, agent_speed, print_intervals)
+        arrival_time_functions.extend(atfs)
+        too_short += node_too_short
+    profiler.count("safe_intervals", len(indices_to_states) + sum(len(x) for x in safe_edge_intervals.values()))
+    profiler.count("atfs", len(arrival_time_functions))
+    profiler.count("atfs_too_short", too_short)
     return safe_node_intervals, safe_edge_intervals, arrival_time_functions, errors, indices_to_states
+
+
+@profiled("write_intervals_to_file")
+def write_intervals_to_file(file, safe_node_intervals, safe_edge_intervals, indices_to_states):
+    """Write SIPP graph to gzip file for the search procedure"""
+    # with open(file + "_unzipped", "wt") as f:
+    with open(file, "wt") as f:
+        f.write("vertex count: " + str(len([x for node in safe_node_intervals for x in safe_node_intervals[node]])) + "\n")
+        f.write("edge count: " + str(len(safe_edge_intervals)) + "\n")
+
+        num_trains = 0
+
+        """ Write safe node intervals, as 'node_name start end id_before id_after'"""
+        for node in safe_node_intervals:
+            for start, end, id_before, id_after, _, _ in safe_node_intervals[node]:
+                max_buffer  = 0.0
+                num_trains = max(num_trains, id_before, id_after)
+                f.write(f"{node} {start} {end} {id_before} {id_after} {max_buffer}\n")
+
+        """Write atfs, as 'from_id to_id zeta alpha beta delta id_before max_buf_before len_unsafe_before id_after max_buf_after len_unsafe_after'"""
+        for from_id, to_id, zeta, alpha, beta, delta, id_before, crt_b, id_after, buffer_after, crt_a, heuristic in safe_edge_intervals:
+            # In our domain there is not really a difference between alpha and zeta since we have no waiting time, so they are the same, but we keep both for extendability.
+            num_trains = max(num_trains, id_before, id_after)
+            f.write(f"{from_id} {to_id} {zeta} {alpha} {beta} {delta} {id_before} {crt_b} {id_after} {buffer_after} {crt_a} {heuristic}\n")
+        f.write(f"num_trains {num_trains}\n")
+
+
+def node_safe_intervals(node, intervals, end_time) -> list[tuple]:
+    """The safe intervals of a block node, between its unsafe intervals and up to end_time."""
+    safe_intervals = []
+    current = 0
+    train_before = 0
+    # Make sure they are ordered in chronological order
+    intervals.sort()
+    # Each tuple is (start, end, duration, train)
+    for start, end, dur, train, _ in intervals:
+        if current > start:
+            interval = (current, start, train_before, train, 0, 0)
+            train_before = train
+            logger.error(f"INTERVAL ERROR safe node interval {interval} on node {node} has later end than start.")
+        elif current == start:
+            # Don't add safe intervals like (0,0), but do update for the next interval
+            logger.error(f"INTERVAL ERROR current == end.")
+            train_before = train
+            current = end
+        else:
+            interval = (current, start, train_before, train, 0, 0)
+            safe_intervals.append(interval)
+            train_before = train
+            current = end
+    if current < end_time:
+        last_interval = (current, end_time, train_before, 0, 0, 0)
+        safe_intervals.append(last_interval)
+    return safe_intervals
+
+
+def edge_safe_intervals(node, intervals, end_time) -> list[tuple]:
+    """The safe intervals of a block edge, with the trains and the lengths of the unsafe intervals around them."""
+    safe_intervals = []
+    current = 0
+    train_before = 0
+    dur_before = 0
+    # Make sure they are ordered in chronological order
+    intervals.sort()
+    # Each tuple is (start, end, duration)
+    for start, end, dur, train, _ in intervals:
+        if current > start:
+            interval = (current, start, train_before, train, dur_before, end - start)
+            train_before = train
+            dur_before = end - start
+            logger.info(f"INTERVAL ERROR safe node interval {interval} on node {node} has later end than start.")
+        elif current == start:
+            # Don't add safe intervals like (0,0), but do update for the next interval
+            logger.error(f"INTERVAL ERROR current == end.")
+            train_before = train
+            dur_before = end - start
+            current = end
+        else:
+            interval = (current, start, train_before, train, dur_before, end - start)
+            safe_intervals.append(interval)
+            train_before = train
+            dur_before = end - start
+            current = end
+    if current < end_time:
+        last_interval = (current, end_time, train_before, 0, dur_before, 0)
+        safe_intervals.append(last_interval)
+    return safe_intervals
+
+
+def number_states(safe_node_intervals, safe_edge_intervals):
+    """
+    The states are numbered by position: the safe intervals of each node, and then of each edge, get a contiguous
+    range of indices starting at first_state, so the i-th interval of node n is state first_state[n] + i.
+    Returns first_state and the node of each node state.
+    """
+    first_state = {}
+    indices_to_states = []
+    for node in safe_node_intervals:
+        first_state[node] = len(indices_to_states)
+        indices_to_states.extend([node] * len(safe_node_intervals[node]))
+    index = len(indices_to_states)
+    for node in safe_edge_intervals:
+        first_state[node] = index
+        index += len(safe_edge_intervals[node])
+    return first_state, indices_to_states
+
+
+def interval_bounds(safe_intervals):
+    """
+    The starts and the ends of the safe intervals of a block. Both increase, so the intervals overlapping a time window
+    form a contiguous range that is found by bisection, instead of testing every interval.
+    """
+    return [x[0] for x in safe_intervals], [x[1] for x in safe_intervals]
+
+
+def node_atfs(g, node, safe_node_intervals, safe_edge_intervals, bounds, first_state, buffer_times, recovery_times,
+              heuristic, agent_speed, print_intervals=False):
+    """The ATFs from the safe intervals of node over its outgoing edges, and the number of moves found too short."""
+    arrival_time_functions = []
+    too_short = 0
+    tracing = tracer.enabled
+    # Interval is the safe interval on the from node: (start-time, end-time)
+    for from_index, from_interval in enumerate(safe_node_intervals[node], start=first_state[node]):
+        for o in g.nodes[node].outgoing:
+            delta = o.length / agent_speed
+            edge_intervals = safe_edge_intervals[o.get_identifier()]
+            edge_starts, edge_ends = bounds[o.get_identifier()]
+            to_intervals = safe_node_intervals[o.to_node.name]
+            to_starts, to_ends = bounds[o.to_node.name]
+            # The safe intervals on the to node that overlap the from interval
+            to_first = bisect_left(to_ends, from_interval[0])
+            to_last = bisect_right(to_starts, from_interval[1])
+            if not edge_intervals or to_first >= to_last:
+                # If this is an opposite edge which cannot be connected due to node occupied it is okay that is not found
+                # This is true if this edge interval does not happen on the path of any agent
+                # logger.info(f"INFO - NOT FOUND an interval for edge <{o.from_node.name},{o.to_node.name}> interval on from node {from_interval} (state {from_index}) and intervals on to node are {safe_node_intervals[o.to_node.name]}")
+                continue
+            # Only the edge intervals that overlap the from interval can give beta > alpha
+            edge_first = bisect_right(edge_ends, from_interval[0])
+            edge_last = bisect_left(edge_starts, from_interval[1])
+            # For later edge intervals the to intervals they can connect to, [first, last), only move forward
+            first = last = to_first
+            for edge_interval in edge_intervals[edge_first:edge_last]:
+                while first < to_last and to_ends[first] - delta <= edge_interval[0]:
+                    first += 1
+                while last < to_last and to_starts[last] - delta < edge_interval[1]:
+                    last += 1
+                # The safe interval on the to node (start-time, end-time)
+                for to_position in range(first, last):
+                    to_interval = to_intervals[to_position]
+                    to_index = first_state[o.to_node.name] + to_position
+                    # zeta: start of u interval, so the interval is same as from node
+                    zeta = from_interval[0]
+                    # alpha: start of safe interval, without wait time, it will be the same as zeta
+                    alpha = max(edge_interval[0], from_interval[0], to_interval[0] - delta)
+                    # beta: end of safe interval on u
+                    beta = min(edge_interval[1], from_interval[1], to_interval[1] - delta)
+
+                    # TODO: check why the alpha is what it is, from that interval we select the train_before/after.
+                    #  It's most likely the edge (maybe always?)
+                    train_before = edge_interval[2]
+                    train_after = edge_interval[3]
+
+                    buffer_after = 0
+                    crt_a = 0
+                    if train_after != 0 and o.get_identifier() in buffer_times[train_after]:
+                        buffer_after = buffer_times[train_after][o.get_identifier()]
+                        crt_a = recovery_times[train_after][o.get_identifier()]
+                    elif train_after != 0 and print_intervals:
+                        logger.error(f"ERROR - Buffer time not found while it should have one for train {train_after} "
+                              f"at {o.get_identifier()}")
+
+                    crt_b = 0
+                    if train_before != 0 and o.get_identifier() in recovery_times[train_before]:
+                        crt_b = recovery_times[train_before][o.get_identifier()]
+                    elif train_before != 0 and print_intervals:
+                        logger.error(f"ERROR - Recovery time not found while it should have one for train {train_before} "
+                              f"at {o.get_identifier()}")
+
+                    h = heuristic[o.to_node.name]
+
+                    # If the interval is too short to make the move, don't include it.
+                    if beta > alpha:
+                        arrival_time_functions.append((
+                            from_index,
+                            to_index,
+                            zeta,
+                            alpha,
+                            beta,
+                            delta, # delta: length of the edge or in case of A-B edge the time to walk to the other side
+                            train_before,
+                            crt_b,
+                            train_after,
+                            buffer_after,
+                            crt_a,
+                            h
+                        ))
+                        if tracing:
+                            tracer.emit("atf", from_node=node, to_node=o.to_node.name, from_interval=from_interval,
+                                        to_interval=to_interval, atf=arrival_time_functions[-1])
+                    else:
+                        too_short += 1
+                        if tracing:
+                            tracer.emit("too_short", from_node=node, to_node=o.to_node.name, from_interval=from_interval,
+                                        to_interval=to_interval, edge_interval=edge_interval, alpha=alpha, beta=beta)
+    return arrival_time_functions, too_short
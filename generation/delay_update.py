@@ -0,0 +1,161 @@
+from logging import getLogger
+
+from generation.buffer_time import flexibility
+from generation.convert_to_safe_intervals import edge_safe_intervals, interval_bounds, node_atfs, node_safe_intervals, number_states, write_intervals_to_file
+from generation.graph import TrackGraph, BlockGraph
+from generation.instrumentation import profiled, profiler
+from generation.interval_generation import calculate_heuristic, combine_intervals, combine_intervals_per_train, process_train, process_trains, sort_and_merge
+from generation.signal_sections import convertMovesToBlock
+
+logger = getLogger('__main__.' + __name__)
+
+
+class DelayUpdate:
+    """
+    The safe interval graph of an agent in a scenario, kept together with the unsafe intervals of each train and the
+    flexibility of the trains, so it can be updated when the movements of a single train change, e.g. by a delay.
+    The graph is the one create_safe_intervals builds for the scenario, and update_train keeps it equal to the graph of
+    the changed scenario: only the blocks the train occupied before or after the change are combined again, only the
+    trains that pass one of these blocks get their flexibility computed again, and only the ATFs leaving a node next to
+    a block whose safe intervals, buffer times or recovery times changed are built again.
+    The data of the scenario is changed in place.
+    """
+    def __init__(self, data, g: TrackGraph, g_block: BlockGraph, destination, agent_speed, agent=-1,
+                 max_buffer_time=float("inf"), use_recovery_time=True, processes=1):
+        self.data = data
+        self.g = g
+        self.g_block = g_block
+        self.destination = destination
+        self.agent_speed = agent_speed
+        self.agent = agent
+        self.max_buffer_time = max_buffer_time
+        self.use_recovery_time = use_recovery_time
+        self.processes = processes
+        self.block_edges = {e.get_identifier(): e for e in g_block.edges}
+        self.heuristic = calculate_heuristic(g_block, g_block.nodes[destination], agent_speed)
+        self.build()
+
+    @profiled("DelayUpdate.build")
+    def build(self):
+        """Generate the whole graph from the scenario."""
+        self.block_intervals_per_train, self.moves_per_agent = process_trains(self.data, self.g, self.g_block, self.processes)
+        self.block_routes = convertMovesToBlock(self.moves_per_agent, self.g)
+        self.route_blocks = {train: route_blocks(routes) for train, routes in self.block_routes.items()}
+        self.intervals = combine_intervals_per_train(self.block_intervals_per_train, self.g_block, self.agent)
+        self.buffer_times, self.recovery_times = flexibility(self.intervals, self.block_routes, self.max_buffer_time, self.use_recovery_time)
+        self.safe_node_intervals = {n: node_safe_intervals(n, self.intervals[n], self.g.global_end_time) for n in self.g_block.nodes}
+        self.safe_edge_intervals = {e: edge_safe_intervals(e, self.intervals[e], self.g.global_end_time) for e in self.block_edges}
+        self.first_state, self.indices_to_states = number_states(self.safe_node_intervals, self.safe_edge_intervals)
+        self.bounds = {block: interval_bounds(safe) for block, safe in (self.safe_node_intervals | self.safe_edge_intervals).items()}
+        self.atfs = {node: self.node_atfs(node) for node in self.safe_node_intervals}
+
+    def node_atfs(self, node):
+        atfs, _ = node_atfs(self.g_block, node, self.safe_node_intervals, self.safe_edge_intervals, self.bounds, self.first_state,
+                            self.buffer_times, self.recovery_times, self.heuristic, self.agent_speed)
+        return atfs
+
+    @profiled("DelayUpdate.update_train")
+    def update_train(self, train, entry) -> set[str]:
+        """
+        Replace the scenario entry of train, with its changed movements, and update the graph.
+        Returns the nodes whose outgoing ATFs were built again.
+        """
+        self.data["trains"][train - 1] = entry
+        global_end_time = max([2 * move["endTime"] for train_entry in self.data["trains"] for move in train_entry["movements"]])
+        if global_end_time != self.g.global_end_time:
+            # The last safe interval of every block ends at the end of the planning horizon
+            logger.info(f"The planning horizon changed from {self.g.global_end_time} to {global_end_time}, generating the whole graph")
+            self.build()
+            return set(self.safe_node_intervals)
+
+        # The unsafe intervals of the train, and the blocks it occupied before or occupies now
+        result = process_train(self.data, train, self.g, self.g_block)
+        for e, departure_time in result.stops.items():
+            e.set_stop_at_station(train, departure_time)
+        for e, (cur_time, end_time, block_edge) in result.plotting_info.items():
+            e.set_plotting_info(train, cur_time, end_time, block_edge)
+        blocks = set(self.block_intervals_per_train[train]) | set(result.block_intervals)
+        self.block_intervals_per_train[train] = result.block_intervals
+        self.moves_per_agent[train] = result.moves
+        self.block_routes[train] = convertMovesToBlock(self.moves_per_agent, self.g, train)[train]
+        self.route_blocks[train] = route_blocks(self.block_routes[train])
+
+        changed = {n: [] for n in blocks}
+        combine_intervals(self.block_intervals_per_train, changed, self.agent)
+        sort_and_merge(changed)
+        self.intervals.update(changed)
+
+        # The buffer and recovery times of a train depend on the intervals of all blocks of its route
+        trains = {t for t, route in self.route_blocks.items() if t == train or route & blocks}
+        buffer_times, recovery_times = flexibility(self.intervals, {t: self.block_routes[t] for t in trains},
+                                                   self.max_buffer_time, self.use_recovery_time)
+        changed_edges = set()
+        for t in trains:
+            old_buffer_times, old_recovery_times = self.buffer_times.get(t, {}), self.recovery_times.get(t, {})
+            for e in old_buffer_times.keys() | buffer_times[t].keys():
+                if old_buffer_times.get(e) != buffer_times[t].get(e) or old_recovery_times.get(e) != recovery_times[t].get(e):
+                    changed_edges.add(e)
+        self.buffer_times |= buffer_times
+        self.recovery_times |= recovery_times
+
+        changed_blocks = set()
+        for block in blocks:
+            if block in self.block_edges:
+                safe_intervals = edge_safe_intervals(block, self.intervals[block], self.g.global_end_time)
+                old_safe_intervals = self.safe_edge_intervals[block]
+                self.safe_edge_intervals[block] = safe_intervals
+            else:
+                safe_intervals = node_safe_intervals(block, self.intervals[block], self.g.global_end_time)
+                old_safe_intervals = self.safe_node_intervals[block]
+                self.safe_node_intervals[block] = safe_intervals
+            if safe_intervals != old_safe_intervals:
+                changed_blocks.add(block)
+                self.bounds[block] = interval_bounds(safe_intervals)
+
+        # The ATFs of a node depend on its safe intervals, and on the safe intervals, buffer times and recovery times
+        # of its outgoing edges and the nodes these lead to
+        nodes = {n for n in changed_blocks if n in self.safe_node_intervals}
+        for block in changed_blocks | changed_edges:
+            if block in self.block_edges:
+                nodes.add(self.block_edges[block].from_node.name)
+            elif block in self.safe_node_intervals:
+                nodes.update(e.from_node.name for e in self.g_block.nodes[block].incoming)
+
+        old_first_state, old_indices_to_states = self.first_state, self.indices_to_states
+        self.first_state, self.indices_to_states = number_states(self.safe_node_intervals, self.safe_edge_intervals)
+        # The ATFs of the other nodes keep their values, their states shift when the number of safe intervals of an
+        # earlier node changed
+        shifted = {n for n in self.safe_node_intervals if self.first_state[n] != old_first_state[n]}
+        for node in self.safe_node_intervals:
+            if node in nodes:
+                self.atfs[node] = self.node_atfs(node)
+            elif node in shifted or any(e.to_node.name in shifted for e in self.g_block.nodes[node].outgoing):
+                self.atfs[node] = self.renumber(self.atfs[node], node, old_first_state, old_indices_to_states)
+        profiler.count("changed_blocks", len(changed_blocks))
+        profiler.count("rebuilt_nodes", len(nodes))
+        logger.info(f"Delay of train {train} changed the safe intervals of {len(changed_blocks)} of {len(blocks)} blocks it "
+                    f"passes, the ATFs of {len(nodes)} nodes were built again")
+        return nodes
+
+    def renumber(self, atfs, node, old_first_state, old_indices_to_states):
+        """The ATFs of node with the states numbered again, after the number of safe intervals of other nodes changed."""
+        shift = self.first_state[node] - old_first_state[node]
+        to_shifts = {}
+        renumbered = []
+        for atf in atfs:
+            to_node = old_indices_to_states[atf[1]]
+            if to_node not in to_shifts:
+                to_shifts[to_node] = self.first_state[to_node] - old_first_state[to_node]
+            renumbered.append((atf[0] + shift, atf[1] + to_shifts[to_node]) + atf[2:])
+        return renumbered
+
+    def arrival_time_functions(self) -> list[tuple]:
+        """All ATFs, in the order of create_safe_intervals."""
+        return [atf for node in self.safe_node_intervals for atf in self.atfs[node]]
+
+    def write(self, file):
+        write_intervals_to_file(file, self.safe_node_intervals, self.arrival_time_functions(), self.indices_to_states)
+
+
+def route_blocks(block_routes) -> set[str]:
+    return {e.get_identifier() for movement in block_routes for e in movement}
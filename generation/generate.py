@@ -17,7 +17,11 @@ from pathlib import Path
 
 from generation.buffer_time import flexibility
 from generation.graph import block_graph_constructor
+from generation.GraphPickler import cached_graphs
 from generation.safe_interval_graph import plot_blocking_staircase
+from generation.signal_sections import convertMovesToBlock
+from generation.instrumentation import profiler
+from generation.trace import STAGES, enable_tracing
 from generation.interval_generation import *
 from generation.convert_to_safe_intervals import *
 from generation.util import read_graph
@@ -36,55 +40,54 @@ parser.add_argument('-v', "--agent_speed", help="(optional) the speed of the age
 parser.add_argument('-p', "--printing", help="(optional) whether to print edge intervals (default=True)", default="True")
 parser.add_argument('-b', "--buffer", help="(optional) max buffer time (default=float(\"inf\")", default=float("inf"))
 parser.add_argument('-r', "--recovery", help="(optional) use recovery time (default=True", default="True")
-
-def read_scenario(file, g, g_block, agent=-1):
+parser.add_argument('-c', "--cache", help="(optional) cache the track and block graph of the location (default=False)", default="False")
+parser.add_argument('-j', "--processes", help="(optional) number of processes used to construct the block graph and to generate the unsafe intervals of the trains (default=1)", default=1, type=int)
+parser.add_argument("--compact", help="(optional) keep the adjacency of the track and block graph in compact arrays, to use less memory (default=False)", default="False")
+parser.add_argument("--all_agents", help="(optional) write the safe intervals for each train of the scenario as the agent to <output>_<train>, the agent heads to the end of its own route at its own speed (default=False)", default="False")
+parser.add_argument("--trace", help=f"(optional) comma separated stages to trace, from {', '.join(STAGES)} or all (default=None)")
+parser.add_argument("--trace_file", help="(optional) file the trace records are written to, one json record per line (default=trace.jsonl)", default="trace.jsonl")
+parser.add_argument("--profile", help="(optional) report the time, peak memory and counters of every stage: 'table' prints them, any other value is the json file they are written to (default=None)")
+
+def load_scenario(file):
     """Read scenario files in json format."""
     try:
         base_path = Path(__file__).parent
         file_path = (base_path / file).resolve()
-        data = json.load(open(file_path))
+        return json.load(open(file_path))
     except:
-        data = json.load(open(file))
+        return json.load(open(file))
+
+def read_scenario(file, g, g_block, agent=-1, processes=1):
+    data = load_scenario(file)
     start_time = time.time()
-    block_intervals, moves_per_agent = process_scenario(data, g, g_block, agent)
+    block_intervals, moves_per_agent = process_scenario(data, g, g_block, agent, processes)
     end_time = time.time()
     return block_intervals, moves_per_agent, end_time - start_time
 
-def write_intervals_to_file(file, safe_node_intervals, safe_edge_intervals, indices_to_states):
-    """Write SIPP graph to gzip file for the search procedure"""
-    # with open(file + "_unzipped", "wt") as f:
-    with open(file, "wt") as f:
-        f.write("vertex count: " + str(len([x for node in safe_node_intervals for x in safe_node_intervals[node]])) + "\n")
-        f.write("edge count: " + str(len(safe_edge_intervals)) + "\n")
-
-        num_trains = 0
-
-        """ Write safe node intervals, as 'node_name start end id_before id_after'"""
-        for node in safe_node_intervals:
-            for start, end, id_before, id_after, _, _ in safe_node_intervals[node]:
-                max_buffer  = 0.0
-                num_trains = max(num_trains, id_before, id_after)
-                f.write(f"{node} {start} {end} {id_before} {id_after} {max_buffer}\n")
-
-        """Write atfs, as 'from_id to_id zeta alpha beta delta id_before max_buf_before len_unsafe_before id_after max_buf_after len_unsafe_after'"""
-        for from_id, to_id, zeta, alpha, beta, delta, id_before, crt_b, id_after, buffer_after, crt_a, heuristic in safe_edge_intervals:
-            # In our domain there is not really a difference between alpha and zeta since we have no waiting time, so they are the same, but we keep both for extendability.
-            num_trains = max(num_trains, id_before, id_after)
-            f.write(f"{from_id} {to_id} {zeta} {alpha} {beta} {delta} {id_before} {crt_b} {id_after} {buffer_after} {crt_a} {heuristic}\n")
-        f.write(f"num_trains {num_trains}\n")
-
-def time_graph_creation(location):
+def write_profile(destination):
+    """Print the profile of the run as a table, or write it to destination in json format."""
+    if destination.strip().lower() == "table":
+        print(profiler.summary())
+    else:
+        with open(destination, "wt") as f:
+            json.dump(profiler.report(), f, indent=2)
+
+def time_graph_creation(location, use_cache=False, processes=1, compact=False):
     start_time = time.time()
-    g = read_graph(location)
+    if use_cache:
+        # Both graphs come from the cache together, their time is counted as reading the track graph
+        g, g_block = cached_graphs(location, compact=compact, processes=processes)
+        return g, g_block, time.time() - start_time, 0.0
+    g = read_graph(location, compact)
     end_time = time.time()
     g_time = end_time - start_time
     start_time = time.time()
-    g_block = block_graph_constructor(g)
+    g_block = block_graph_constructor(g, compact=compact, processes=processes)
     end_time = time.time()
     return g, g_block, g_time, end_time - start_time
 
-def time_scenario_creation(scenario, g, g_block, agent_id):
-    block_intervals, moves_per_agent, unsafe_computation_time = read_scenario(scenario, g, g_block, agent_id)
+def time_scenario_creation(scenario, g, g_block, agent_id, processes=1):
+    block_intervals, moves_per_agent, unsafe_computation_time = read_scenario(scenario, g, g_block, agent_id, processes)
     start_time = time.time()
     block_routes = convertMovesToBlock(moves_per_agent, g)
     end_time = time.time()
@@ -96,10 +99,10 @@ def time_flexibility_creation(block_routes, block_intervals, max_buffer_time, us
     end_time = time.time()
     return buffer_times, recovery_times, end_time - start_time
 
-def time_interval_creation(block_intervals, g_block, buffer_times, recovery_times, destination, agent_velocity):
+def time_interval_creation(block_intervals, g_block, buffer_times, recovery_times, destination, agent_velocity, print_intervals=False):
     start_time = time.time()
     safe_block_intervals, safe_block_edges_intervals, atfs, _, indices_to_states = create_safe_intervals(
-        block_intervals, g_block, buffer_times, recovery_times, destination, float(agent_velocity), print_intervals=False)
+        block_intervals, g_block, buffer_times, recovery_times, destination, float(agent_velocity), print_intervals=print_intervals)
     safe_computation_time = time.time() - start_time
     return safe_block_intervals, safe_block_edges_intervals, atfs, indices_to_states, safe_computation_time
 
@@ -108,18 +111,70 @@ def plot_route(plot_agent, moves_per_agent, block_routes, block_intervals, g_blo
         plottings = (moves_per_agent[plot_agent][0], block_routes[plot_agent][0]) if plot_agent in block_routes else None
     plot_blocking_staircase(block_intervals, block_routes, moves_per_agent, g_block, buffer_times, recovery_times, plot_routes=plottings, exclude_agent=exclude_agent)
 
+def generate_all_agents(scenario, g, g_block, output, max_buffer_time, use_recovery_time, processes=1, print_intervals=False):
+    """
+    Write the safe intervals for each train of the scenario as the agent, to <output>_<train>. The unsafe intervals and
+    the flexibility of all trains are computed once. Per agent only the blocks the agent occupies are combined again,
+    and only the trains that pass one of these blocks get their flexibility computed again.
+    """
+    start_time = time.time()
+    data = load_scenario(scenario)
+    types = {x["name"]: x for x in data["types"]}
+    block_intervals_per_train, moves_per_agent = process_trains(data, g, g_block, processes)
+    block_routes = convertMovesToBlock(moves_per_agent, g)
+    combined = combine_intervals_per_train(block_intervals_per_train, g_block, -1)
+    all_buffer_times, all_recovery_times = flexibility(combined, block_routes, max_buffer_time, use_recovery_time)
+    route_blocks = {train: {e.get_identifier() for movement in routes for e in movement} for train, routes in block_routes.items()}
+    logger.info(f"Generating the unsafe intervals of all trains took {time.time() - start_time} seconds")
+
+    output = Path(output)
+    for agent, entry in enumerate(data["trains"], start=1):
+        agent_start_time = time.time()
+        block_route = block_routes[agent][0]
+        if not block_route:
+            logger.warning(f"Skipping train {agent}, its route passes no signal")
+            continue
+        destination = block_route[-1].to_node.name
+        agent_speed = types[entry["trainUnitTypes"][0]]["speed"] / 3.6
+        block_intervals, changed = combine_intervals_without_agent(block_intervals_per_train, combined, agent)
+        affected = {train: block_routes[train] for train, blocks in route_blocks.items() if blocks & changed}
+        buffer_times, recovery_times = flexibility(block_intervals, affected, max_buffer_time, use_recovery_time)
+        buffer_times = all_buffer_times | buffer_times
+        recovery_times = all_recovery_times | recovery_times
+        safe_block_intervals, _, atfs, _, indices_to_states = create_safe_intervals(
+            block_intervals, g_block, buffer_times, recovery_times, destination, agent_speed, print_intervals=print_intervals)
+        write_intervals_to_file(output.with_name(f"{output.stem}_{agent}{output.suffix}"), safe_block_intervals, atfs, indices_to_states)
+        logger.info(f"Creating the safe intervals for train {agent} took {time.time() - agent_start_time} seconds")
+
 
 def main():
     args = parser.parse_args()
-    g, g_block, g_duration = time_graph_creation(args.location)
-    block_intervals, moves_per_agent, computation_time = read_scenario(args.scenario, g, g_block, args.agent_id)
-    block_routes = convertMovesToBlock(moves_per_agent, g)
-    buffer_times, recovery_times = flexibility(block_intervals, block_routes, float(args.buffer), args.recovery.strip().lower() == "true")
+    if args.trace:
+        enable_tracing(args.trace.split(","), args.trace_file)
+    if args.profile:
+        profiler.enable()
+    g, g_block, g_duration, g_block_duration = time_graph_creation(args.location, args.cache.strip().lower() == "true", args.processes,
+                                                                     args.compact.strip().lower() == "true")
+    logger.info(f"Reading the track graph took {g_duration} seconds, creating the block graph took {g_block_duration} seconds")
+    if args.all_agents.strip().lower() == "true":
+        generate_all_agents(args.scenario, g, g_block, args.output, float(args.buffer), args.recovery.strip().lower() == "true",
+                            args.processes, args.printing.strip().lower() == "true")
+        if args.profile:
+            write_profile(args.profile)
+        return
+    block_intervals, moves_per_agent, computation_time, block_routes, block_routes_duration = time_scenario_creation(args.scenario, g, g_block, args.agent_id, args.processes)
+    logger.info(f"Generating the unsafe intervals took {computation_time} seconds, converting the moves to blocks took {block_routes_duration} seconds")
+    buffer_times, recovery_times, flexibility_duration = time_flexibility_creation(block_routes, block_intervals, float(args.buffer), args.recovery.strip().lower() == "true")
+    logger.info(f"Calculating the buffer and recovery times took {flexibility_duration} seconds")
     agent_route = 2
     plot_route = (moves_per_agent[agent_route][0], block_routes[agent_route][0]) if agent_route in block_routes else None
     plot_blocking_staircase(block_intervals, block_routes, moves_per_agent, g_block, buffer_times, recovery_times, plot_routes=plot_route)
-    safe_block_intervals, safe_block_edges_intervals, atfs, _, indices_to_states = create_safe_intervals(block_intervals, g_block, buffer_times, recovery_times, args.destination, float(args.agent_speed), args.recovery.strip().lower() == "true")
+    safe_block_intervals, safe_block_edges_intervals, atfs, indices_to_states, safe_duration = time_interval_creation(
+        block_intervals, g_block, buffer_times, recovery_times, args.destination, args.agent_speed, args.printing.strip().lower() == "true")
+    logger.info(f"Creating the safe intervals took {safe_duration} seconds")
     write_intervals_to_file(args.output, safe_block_intervals, atfs, indices_to_states)
+    if args.profile:
+        write_profile(args.profile)
     # plot_safe_node_intervals(safe_block_intervals | safe_block_edges_intervals, block_routes)
 
 if __name__ == "__main__":
@@ -2,22 +2,25 @@ from __future__ import annotations
 
 import contextlib
 import re
-import os
-import pickle
 import logging
 import sys
 import time
 from enum import Enum
 
+import numpy as np
 import tqdm
-from typing import Iterator
+from types import MappingProxyType
+from typing import Iterator, Mapping
 
 import generation.GraphPickler
 
-from queue import Queue
-from copy import copy
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from logging import getLogger
 
+from generation.instrumentation import profiled, profiler
+from generation.trace import get_tracer
+
 a_to_s = {
     "4.5": 40,
     "7": 40,
@@ -39,6 +42,10 @@ def angle_to_speed(angle):
     return a_to_s[angle] / 3.6
 
 logger = getLogger('__main__.' + __name__)
+tracer = get_tracer("blocks")
+
+# Read-only stand in for per-agent tables that have not been created
+EMPTY_TABLE = MappingProxyType({})
 
 class Direction(Enum):
     SAME = 1
@@ -57,13 +64,30 @@ class TqdmLogger:
         pass
 
 class Node:
+    __slots__ = ("name", "index", "_outgoing", "_incoming", "_adjacency")
+
     def __init__(self, name):
-        self.name = name
-        self.outgoing:list[Edge] = []
-        self.incoming:list[Edge] = []
+        # Node names are used as keys in many dictionaries, interning them shares a single copy of each name
+        self.name = sys.intern(name)
+        self.index = -1
+        self._outgoing:list[Edge] | None = []
+        self._incoming:list[Edge] | None = []
+        self._adjacency: CSRAdjacency | None = None
+
+    @property
+    def outgoing(self) -> list[Edge]:
+        if self._adjacency is not None:
+            return self._adjacency.outgoing(self.index)
+        return self._outgoing
+
+    @property
+    def incoming(self) -> list[Edge]:
+        if self._adjacency is not None:
+            return self._adjacency.incoming(self.index)
+        return self._incoming
 
     def get_identifier(self):
-        return f"{self.name}"
+        return self.name
 
     def __eq__(self, other):
         if isinstance(other, Node):
@@ -83,10 +107,14 @@ class Node:
         return f"{self.name}"
 
 class BlockNode(Node):
+    __slots__ = ()
+
     def __init__(self, name):
         super().__init__(name)
 
 class TrackNode(Node):
+    __slots__ = ("associated", "opposites", "blk", "blocksOpp", "canReverse", "stationPlatform", "type", "direction")
+
     def __init__(self, name, type):
         super().__init__(name)
         self.associated:list[Node] = []
@@ -95,7 +123,7 @@ class TrackNode(Node):
         self.blocksOpp:list[BlockEdge] = []
         self.canReverse = False
         self.stationPlatform = False
-        self.type = type
+        self.type = sys.intern(type)
         self.direction = ''.join(set(re.findall("[AB]", f"{name[-2:]}")))
         if self.direction != "A" and self.direction != "B":
             raise ValueError("Direction must be either A or B")
@@ -108,6 +136,8 @@ class TrackNode(Node):
         return self.blk + self.blocksOpp
 
 class Signal:
+    __slots__ = ("id", "track", "direction")
+
     def __init__(self, id, track: TrackNode):
         self.id = id
         self.track = track
@@ -118,17 +148,23 @@ class Signal:
 
 
 class Edge:
+    __slots__ = ("id", "index", "from_node", "to_node", "length", "max_speed", "_identifier")
     __last_id = 1
     def __init__(self, f:Node, t:Node, l, mv):
         self.id = Edge.__last_id
         Edge.__last_id += 1
+        self.index = -1
         self.from_node = f
         self.to_node = t
         self.length = l
         self.max_speed = mv
+        self._identifier = None
 
     def get_identifier(self):
-        return f"{self.from_node.name}--{self.to_node.name}--{self.id}"
+        # The identifier is the key of the edge in all interval dictionaries, so build it once
+        if self._identifier is None:
+            self._identifier = sys.intern(f"{self.from_node.name}--{self.to_node.name}--{self.id}")
+        return self._identifier
 
     def __repr__(self) -> str:
         return f"Edge from {self.from_node.name} to {self.to_node.name} with length {self.length}"
@@ -146,6 +182,8 @@ class Edge:
         return f"{self.from_node.name}--{self.to_node.name}"
 
 class BlockEdge(Edge):
+    __slots__ = ("tn", "tnAssociated", "tnOpposites", "direction")
+
     def __init__(self, f, t, l, tracknodes_on_route:list[TrackNode], direction, mv):
         super().__init__(f, t, l, mv)
         self.tn:list[TrackNode] = list(tracknodes_on_route)
@@ -154,7 +192,7 @@ class BlockEdge(Edge):
         for n in tracknodes_on_route:
             self.tnAssociated.extend(n.associated)
             self.tnOpposites.extend(n.opposites)
-        self.direction = direction
+        self.direction = sys.intern(direction)
         if self.direction == "BA":
             self.direction = "AB"
 
@@ -174,24 +212,112 @@ class BlockEdge(Edge):
 
 
 class TrackEdge(Edge):
+    __slots__ = ("_plotting_info", "opposites", "associated", "_stops_at_station", "direction")
+
     def __init__(self, f, t, l, switch_angle=None):
         super().__init__(f, t, l, angle_to_speed(switch_angle))
-        self.plotting_info = {}
+        # Only the edges on the path of some agent get plotting and stop information, so create these tables lazily
+        self._plotting_info: dict | None = None
         self.opposites:  list[Edge] = []
         self.associated: list[Edge] = []
-        self.stops_at_station = {}
-        self.direction = ''.join(set(re.findall("[AB]", f"{str(f)[-2:]} {str(t)[-2:]}")))
+        self._stops_at_station: dict | None = None
+        self.direction = sys.intern(''.join(set(re.findall("[AB]", f"{str(f)[-2:]} {str(t)[-2:]}"))))
         # if self.direction != "A" and self.direction != "B":
         #     raise ValueError("Direction must be either A or B")
 
+    @property
+    def plotting_info(self) -> Mapping:
+        return self._plotting_info if self._plotting_info is not None else EMPTY_TABLE
+
+    @property
+    def stops_at_station(self) -> Mapping:
+        return self._stops_at_station if self._stops_at_station is not None else EMPTY_TABLE
 
     def set_plotting_info(self, agent, cur_time, end_time, block_edge):
-        self.plotting_info[agent] = {
+        if self._plotting_info is None:
+            self._plotting_info = {}
+        self._plotting_info[agent] = {
             "start_time": cur_time,
             "end_time": end_time,
             "block": block_edge,
         }
 
+    def set_stop_at_station(self, agent, departure_time):
+        if self._stops_at_station is None:
+            self._stops_at_station = {}
+        self._stops_at_station[agent] = departure_time
+
+
+class CSRAdjacency:
+    """
+    Compressed sparse row adjacency of a graph. Nodes and edges are addressed by their index in the graph, the
+    outgoing edges of node i are out_edges[out_offsets[i]:out_offsets[i + 1]] and lead to the nodes in out_targets at
+    the same positions (incoming edges and their in_sources likewise). The searches walk these arrays and the lengths
+    and max_speeds of the edges directly, instead of the edge lists of the nodes.
+    """
+    def __init__(self, graph: Graph):
+        self.nodes: list[Node] = list(graph.nodes.values())
+        self.edges: list[Edge] = graph.edges
+        n = len(graph.nodes)
+        sources = np.fromiter((e.from_node.index for e in graph.edges), dtype=np.int32, count=len(graph.edges))
+        targets = np.fromiter((e.to_node.index for e in graph.edges), dtype=np.int32, count=len(graph.edges))
+        self.lengths = np.fromiter((e.length for e in graph.edges), dtype=np.float64, count=len(graph.edges))
+        self.max_speeds = np.fromiter((e.max_speed for e in graph.edges), dtype=np.float64, count=len(graph.edges))
+        self.out_offsets, self.out_edges = self._group_by(sources, n)
+        self.in_offsets, self.in_edges = self._group_by(targets, n)
+        # Neighbour of each entry in out_edges/in_edges, so a search does not have to go through the edges
+        self.out_targets = targets[self.out_edges]
+        self.in_sources = sources[self.in_edges]
+
+    @staticmethod
+    def _group_by(keys, n):
+        # A stable sort keeps the edges of each node in insertion order, like the per-node lists did
+        order = np.argsort(keys, kind="stable").astype(np.int32)
+        offsets = np.zeros(n + 1, dtype=np.int32)
+        np.cumsum(np.bincount(keys, minlength=n), out=offsets[1:])
+        return offsets, order
+
+    def outgoing(self, index) -> list[Edge]:
+        edges = self.edges
+        return [edges[i] for i in self.out_edges[self.out_offsets[index]:self.out_offsets[index + 1]].tolist()]
+
+    def incoming(self, index) -> list[Edge]:
+        edges = self.edges
+        return [edges[i] for i in self.in_edges[self.in_offsets[index]:self.in_offsets[index + 1]].tolist()]
+
+    def edge_lists(self, offsets, edge_indices) -> list[list[Edge]]:
+        """The edges of every node as separate lists, converting the arrays once instead of slicing them per node."""
+        edges = self.edges
+        offsets = offsets.tolist()
+        edge_indices = edge_indices.tolist()
+        return [[edges[i] for i in edge_indices[offsets[n]:offsets[n + 1]]] for n in range(len(offsets) - 1)]
+
+    def search_arrays(self, agent_velocity=None, reverse=False):
+        """
+        The offsets, neighbours and edges of every node, over the outgoing edges or over the incoming edges when
+        reverse is set, and the weights of these edges in the same order: their travel time at agent_velocity, or their
+        length when no velocity is given. They are memoryviews on the arrays, indexing one gives a Python number.
+        """
+        if reverse:
+            offsets, neighbours, edges = self.in_offsets, self.in_sources, self.in_edges
+        else:
+            offsets, neighbours, edges = self.out_offsets, self.out_targets, self.out_edges
+        weights = self.lengths[edges]
+        if agent_velocity is not None:
+            weights /= np.minimum(self.max_speeds[edges], agent_velocity)
+        return memoryview(offsets), memoryview(neighbours), memoryview(edges), memoryview(weights)
+
+    def neighbour_lists(self) -> list[list[tuple]]:
+        """(to, length, max_speed) of the outgoing edges of every node, the adjacency signal_block_routes takes."""
+        edges = self.edges
+        offsets = self.out_offsets.tolist()
+        neighbours = [(to, edges[e].length, edges[e].max_speed) for to, e in zip(self.out_targets.tolist(), self.out_edges.tolist())]
+        return [neighbours[offsets[n]:offsets[n + 1]] for n in range(len(offsets) - 1)]
+
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.lengths, self.max_speeds, self.out_offsets, self.out_edges, self.in_offsets,
+                                      self.in_edges, self.out_targets, self.in_sources))
+
 
 class Graph:
     def __init__(self):
@@ -199,19 +325,77 @@ class Graph:
         self.nodes: dict[str, Node] = {}
         self.global_end_time = -1
         self.stations: dict[str, (str, str)] = {}
+        self.csr: CSRAdjacency | None = None
 
     def add_node(self, n):
         if isinstance(n, Node):
+            if n.name not in self.nodes:
+                n.index = len(self.nodes)
+            else:
+                n.index = self.nodes[n.name].index
             self.nodes[n.name] = n
             return n
 
     def add_edge(self, e):
         if isinstance(e, Edge):
+            if self.csr is not None:
+                self.expand()
+            e.index = len(self.edges)
             self.edges.append(e)
-            e.to_node.incoming.append(e)
-            e.from_node.outgoing.append(e)
+            e.to_node._incoming.append(e)
+            e.from_node._outgoing.append(e)
             return e
 
+    def remove_edges(self, edges):
+        """Remove the given edges, the remaining edges keep their order but get a new index."""
+        # Keyed by object, a removed node and the node replacing it have the same name and so compare equal
+        removed = {id(e): e for e in edges}
+        if not removed:
+            return
+        self.expand()
+        nodes = {id(n): n for e in removed.values() for n in (e.from_node, e.to_node)}
+        for node in nodes.values():
+            node._outgoing = [e for e in node._outgoing if id(e) not in removed]
+            node._incoming = [e for e in node._incoming if id(e) not in removed]
+        self.edges = [e for e in self.edges if id(e) not in removed]
+        for i, e in enumerate(self.edges):
+            e.index = i
+
+    def remove_nodes(self, nodes):
+        """Remove the given nodes together with their edges, the remaining nodes get a new index."""
+        nodes = [n for n in nodes if self.nodes.get(n.name) is n]
+        if not nodes:
+            return
+        self.expand()
+        self.remove_edges([e for n in nodes for e in n._outgoing + n._incoming])
+        for n in nodes:
+            del self.nodes[n.name]
+        for i, n in enumerate(self.nodes.values()):
+            n.index = i
+
+    def compact(self):
+        """Move the adjacency of all nodes into CSR arrays, the incoming/outgoing lists become views on these arrays."""
+        if self.csr is not None:
+            return self.csr
+        self.csr = CSRAdjacency(self)
+        for node in self.nodes.values():
+            node._outgoing = None
+            node._incoming = None
+            node._adjacency = self.csr
+        return self.csr
+
+    def expand(self):
+        """Inverse of compact: give every node its own incoming/outgoing lists again, so the graph can be modified."""
+        if self.csr is None:
+            return
+        outgoing = self.csr.edge_lists(self.csr.out_offsets, self.csr.out_edges)
+        incoming = self.csr.edge_lists(self.csr.in_offsets, self.csr.in_edges)
+        for node, out_edges, in_edges in zip(self.nodes.values(), outgoing, incoming):
+            node._outgoing = out_edges
+            node._incoming = in_edges
+            node._adjacency = None
+        self.csr = None
+
     def __repr__(self) -> str:
         return f"Graph with {len(self.edges)} edges and {len(self.nodes)} nodes:\n{self.nodes.values()}"
 
@@ -238,23 +422,40 @@ class TrackGraph(Graph):
         self.signals: list[Signal] = []
         self.distance_markers = {}
         self.file_name = file_name
+        # Connections of the track parts of the location file by id, needed to reconnect the graph after a layout edit
+        self.track_parts: dict[int, tuple] = {}
+        # Station to station routes, see route_table.RouteTable
+        self.routes = None
+        # Track nodes that hold a signal, see signal_sections.signal_tracks
+        self.signal_tracks = None
 
     def add_signal(self, s):
         if isinstance(s, Signal):
             self.signals.append(s)
+            self.signal_tracks = None
 
 
 class BlockGraph(Graph):
-    def __init__(self, g: TrackGraph):
+    def __init__(self, g: TrackGraph, compact=False, processes=1):
         super().__init__()
         logger.info("Creating initial signals")
-        track_to_signal = {signal.track: signal for signal in g.signals}
         for signal in g.signals:
             block = self.add_node(BlockNode(f"r-{signal.id}"))
             signal.track.blk.append(block)
-        for signal in tqdm.tqdm(g.signals, file=TqdmLogger(logger), mininterval=1, ascii=False):
-            logger.debug(f"Expanding blocks of {signal}")
-            blocks = self.generate_signal_blocks(signal, g.signals)
+        logger.info("Expanding blocks of all signals")
+        self.add_signal_blocks(g, g.signals, processes)
+        self.map_stations(g)
+        if compact:
+            self.compact()
+
+    def __eq__(self, other):
+        return super().__eq__(other)
+
+    def add_signal_blocks(self, g: TrackGraph, signals: list[Signal], processes=1):
+        """Add the block edges starting at each of signals, the block nodes of all signals of g must exist already."""
+        track_to_signal = {signal.track: signal for signal in g.signals}
+        signal_blocks = self.generate_signal_blocks(g, signals, processes)
+        for signal, blocks in tqdm.tqdm(zip(signals, signal_blocks), total=len(signals), file=TqdmLogger(logger), mininterval=1, ascii=False):
             for idx, (block, length, max_velocity) in enumerate(blocks):
 
                 # Create edges in g_block
@@ -265,7 +466,12 @@ class BlockGraph(Graph):
                 to_signal_node = self.nodes[f"r-{to_signal.id}"]
                 direction = "".join(set(signal.direction + to_signal.direction))
                 e = self.add_edge(BlockEdge(from_signal_node, to_signal_node, length, block, direction, max_velocity))
-                logger.debug(f"Found block {e} with length {length} and max velocity {max_velocity}")
+                if tracer.enabled:
+                    tracer.emit("block", block=e, length=length, max_velocity=max_velocity)
+
+    def map_stations(self, g: TrackGraph):
+        """Map every station of g to the blocks ending at its platform track, one for each direction."""
+        self.stations = {}
         for station, track_nodes in g.stations.items():
             node_a, node_b = track_nodes
 
@@ -285,9 +491,6 @@ class BlockGraph(Graph):
 
             self.stations[station] = (station_block_a.pop(), station_block_b.pop())
 
-    def __eq__(self, other):
-        return super().__eq__(other)
-
     def add_edge(self, e):
         super().add_edge(e)
 
@@ -298,58 +501,112 @@ class BlockGraph(Graph):
 
         return e
 
-    def generate_signal_blocks(self, from_signal: Signal, signals: list[Signal]):
-        end_tracks = {s.track.get_identifier() for s in signals}
-        start_track = from_signal.track
-
-        result = []
-
-        queue = Queue()
-        queue.put(([start_track], {start_track}, 0, sys.maxsize))
-
-        while not queue.empty():
-            route, visited, length, max_velocity = queue.get()
-
-            if len(route[-1].outgoing) == 0:
-                #No outgoing edges, what to do?
-                # Should only happen when at the end of a track, and it's not allowed to turn around
-                logger.debug(f"No outgoing edges at {route[-1]}")
-                continue
-
-            for e in route[-1].outgoing:
-                next_track = e.to_node
-
-                if next_track.get_identifier() in end_tracks:
-                    route = copy(route)
-                    route.append(next_track)
-                    result.append((route[1:], length + e.length, min(max_velocity, e.max_speed)))
-
-                elif next_track not in visited:
-                    route = copy(route)
-                    visited = copy(visited)
-
-                    visited.add(next_track)
-                    route.append(next_track)
-                    queue.put((route, visited, length + e.length, min(max_velocity, e.max_speed)))
-
-        return result
-
-
-def block_graph_constructor(g: TrackGraph, use_pickle=False):
+    def remove_edges(self, edges):
+        edges = list(edges)
+        removed = {id(e) for e in edges}
+        track_nodes = {id(n): n for e in edges for n in e.tracknodes(Direction.BOTH)}
+        for node in track_nodes.values():
+            node.blk = [x for x in node.blk if id(x) not in removed]
+            node.blocksOpp = [x for x in node.blocksOpp if id(x) not in removed]
+        super().remove_edges(edges)
+
+    @staticmethod
+    @profiled("generate_signal_blocks")
+    def generate_signal_blocks(g: TrackGraph, from_signals: list[Signal], processes=1):
+        """
+        Find the routes from each of from_signals to the next signals of g, as lists of (route, length, max_velocity).
+        With more than one process the signals are split over a process pool, the routes are merged in signal order
+        so the result is the same as the serial one.
+        """
+        tracks = list(g.nodes.values())
+        if g.csr is not None:
+            adjacency = g.csr.neighbour_lists()
+        else:
+            adjacency = [[(e.to_node.index, e.length, e.max_speed) for e in track.outgoing] for track in tracks]
+        end_tracks = {s.track.index for s in g.signals}
+        starts = [s.track.index for s in from_signals]
+
+        if processes > 1 and len(starts) > 1:
+            # Several chunks per process, so one slow corridor does not keep the other processes waiting
+            chunk_size = max(1, -(-len(starts) // (4 * processes)))
+            chunks = [starts[i:i + chunk_size] for i in range(0, len(starts), chunk_size)]
+            with ProcessPoolExecutor(processes, initializer=_init_block_worker, initargs=(adjacency, end_tracks)) as pool:
+                routes = [r for chunk in pool.map(_signal_block_worker, chunks) for r in chunk]
+        else:
+            routes = signal_block_routes(adjacency, starts, end_tracks)
+        profiler.count("signal_blocks", sum(len(blocks) for blocks in routes))
+
+        return [[([tracks[i] for i in route], length, max_velocity) for route, length, max_velocity in blocks] for blocks in routes]
+
+
+def signal_block_routes(adjacency, starts, end_tracks):
+    """
+    Find the routes from each of the start tracks to the next end tracks, as lists of (route, length, max_velocity) where
+    the route is a tuple of track indices. adjacency holds (to, length, max_speed) of the outgoing edges of every track.
+    All starts are expanded in one breadth first search. A route is stored as a chain of (track, visited, previous)
+    links, so routes share their common prefix instead of copying it at every branch. Like the route lists this
+    replaces, a route also contains the tracks of the branches found before it at the same switch.
+    """
+    result = [[] for _ in starts]
+
+    queue = deque()
+    for source, start in enumerate(starts):
+        queue.append((source, (start, True, None), 0, sys.maxsize))
+
+    while queue:
+        source, route, length, max_velocity = queue.popleft()
+
+        # No outgoing edges: should only happen when at the end of a track, and it's not allowed to turn around
+        for next_track, edge_length, max_speed in adjacency[route[0]]:
+
+            if next_track in end_tracks:
+                route = (next_track, False, route)
+                result[source].append((route_tracks(route), length + edge_length, min(max_velocity, max_speed)))
+
+            elif not route_visits(route, next_track):
+                route = (next_track, True, route)
+                queue.append((source, route, length + edge_length, min(max_velocity, max_speed)))
+
+    return result
+
+
+_block_worker_graph = None
+
+def _init_block_worker(adjacency, end_tracks):
+    global _block_worker_graph
+    _block_worker_graph = (adjacency, end_tracks)
+
+def _signal_block_worker(starts):
+    adjacency, end_tracks = _block_worker_graph
+    return signal_block_routes(adjacency, starts, end_tracks)
+
+
+def route_tracks(route) -> tuple:
+    """The tracks of a route chain in driving order, without the track of the start signal."""
+    tracks = []
+    while route[2] is not None:
+        tracks.append(route[0])
+        route = route[2]
+    tracks.reverse()
+    return tuple(tracks)
+
+
+def route_visits(route, track) -> bool:
+    while route is not None:
+        if route[1] and route[0] == track:
+            return True
+        route = route[2]
+    return False
+
+
+@profiled("block_graph_constructor")
+def block_graph_constructor(g: TrackGraph, use_pickle=False, compact=False, processes=1):
     if not use_pickle:
-        return BlockGraph(g)
-
-    last_modified = os.path.getmtime(g.file_name)
-    filename = f"{g.file_name}-{last_modified}-g_block.pkl"
-    if os.path.exists(filename):
-        logger.info("Using existing track graph")
-        start = time.time()
-        g_block = generation.GraphPickler.unpickleGraph(filename, g)
-        duration = time.time() - start
-        logger.info(f"Unpickling graph took {duration} seconds")
-        return g_block
-    g_block = BlockGraph(g)
-    with open(f"{g.file_name}-{last_modified}-g_block.pkl", "wb") as f:
-        pickler = generation.GraphPickler.GraphPickler(f, pickle.HIGHEST_PROTOCOL)
-        pickler.dump(g_block)
-    return g_block
\ No newline at end of file
+        return BlockGraph(g, compact, processes)
+
+    start = time.time()
+    g_block = generation.GraphPickler.cached_block_graph(g, processes=processes)
+    logger.info(f"Loading block graph took {time.time() - start} seconds")
+    if compact:
+        g_block.compact()
+    return g_block
@@ -0,0 +1,116 @@
+import time
+import functools
+import tracemalloc
+from contextlib import contextmanager
+
+
+class StageStats:
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.peak_bytes = 0
+        self.counters: dict[str, int] = {}
+
+
+class Profiler:
+    """
+    Wall time, peak memory and counters per stage of the generation. Stages are opened with the stage context manager
+    or the profiled decorator and may nest, the time and memory of a stage include the stages inside it. Counters are
+    added to the innermost open stage, or to "total" outside any stage.
+    Until enable is called a stage only checks the enabled flag, so the instrumented functions run as before. Peak
+    memory is measured with tracemalloc, which slows down a profiled run. The work of process pool workers is timed as
+    part of the stage that started the pool, their counters are not included.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.stages: dict[str, StageStats] = {}
+        # [name, traced memory at the start, highest traced memory] of the open stages, innermost last
+        self.open = []
+        self.start = 0.0
+        self.started_tracemalloc = False
+
+    def enable(self):
+        self.stages = {}
+        self.started_tracemalloc = not tracemalloc.is_tracing()
+        if self.started_tracemalloc:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        self.open = [["total", current, current]]
+        self.start = time.perf_counter()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        self.open = []
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        self.sample_peak()
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        entry = [name, current, current]
+        self.open.append(entry)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.sample_peak()
+            self.open.pop()
+            stats = self.stages.setdefault(name, StageStats())
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.peak_bytes = max(stats.peak_bytes, entry[2] - entry[1])
+            # The peak of a stage is also reached in the stages around it
+            if self.open:
+                self.open[-1][2] = max(self.open[-1][2], entry[2])
+
+    def sample_peak(self):
+        """Add the peak since the last reset to the innermost open stage."""
+        if self.open:
+            self.open[-1][2] = max(self.open[-1][2], tracemalloc.get_traced_memory()[1])
+
+    def count(self, counter, n=1):
+        if self.enabled:
+            counters = self.stages.setdefault(self.open[-1][0], StageStats()).counters
+            counters[counter] = counters.get(counter, 0) + n
+
+    def report(self) -> dict:
+        """The stages in the order they were first finished, with the whole run as "total"."""
+        self.sample_peak()
+        total = self.stages.setdefault("total", StageStats())
+        total.calls = 1
+        total.seconds = time.perf_counter() - self.start
+        total.peak_bytes = self.open[0][2] - self.open[0][1]
+        return {name: {"calls": stats.calls, "seconds": round(stats.seconds, 4), "peak_mb": round(stats.peak_bytes / 2 ** 20, 3),
+                       "counters": stats.counters} for name, stats in self.stages.items()}
+
+    def summary(self) -> str:
+        lines = [f"{'stage':<28} {'calls':>6} {'seconds':>9} {'peak MB':>9}  counters"]
+        for name, stats in self.report().items():
+            counters = ", ".join(f"{counter}={value}" for counter, value in stats["counters"].items())
+            lines.append(f"{name:<28} {stats['calls']:>6} {stats['seconds']:>9.4f} {stats['peak_mb']:>9.2f}  {counters}")
+        return "\n".join(lines)
+
+
+profiler = Profiler()
+
+
+def profiled(name):
+    """Run every call of the decorated function as the stage name of the profiler."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return function(*args, **kwargs)
+            with profiler.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,40 +1,62 @@
 import sys
-import queue as Q
+from collections import defaultdict, namedtuple
+from heapq import heappop, heappush
 from logging import getLogger
 
-from generation.graph import BlockEdge, Graph, Node, TrackEdge, TrackGraph, BlockGraph, Direction
-from generation.signal_sections import convertMovesToBlock
+from generation.graph import BlockEdge, CSRAdjacency, Graph, Node, TrackEdge, TrackGraph, BlockGraph, Direction
+from generation.instrumentation import profiled, profiler
+from generation.route_table import route_table
+from generation.signal_sections import convertMoveToBlock, signal_tracks
+from generation.trace import get_tracer
 
 logger = getLogger('__main__.' + __name__)
+tracer = get_tracer("unsafe_intervals")
+
+# The outcome of processing the moves of one train: its unsafe intervals per block, its paths, and the stops and
+# plotting information for the track edges of its paths, which are only set on the edges once all trains are done
+TrainResult = namedtuple("TrainResult", ["block_intervals", "moves", "stops", "plotting_info"])
+
+def process_scenario(data, g: TrackGraph, g_block: BlockGraph, agent, processes=1):
+    """
+    Process the data from the scenario.
+    With more than one process the trains are split over a process pool, the results are merged in train order so
+    they are the same as the serial ones.
+    """
+    block_intervals, moves_per_agent = process_trains(data, g, g_block, processes)
+    # Combine intervals and merge overlapping intervals, taking into account the current agent
+    block_intervals = combine_intervals_per_train(block_intervals, g_block, agent)
+    check_intervals(block_intervals)
+    return block_intervals, moves_per_agent
 
-def process_scenario(data, g: TrackGraph, g_block: BlockGraph, agent):
-    """Process the data from the scenario."""
+
+@profiled("process_trains")
+def process_trains(data, g: TrackGraph, g_block: BlockGraph, processes=1):
+    """The unsafe intervals of each train of the scenario per block, and the paths of each train."""
     # Create a global end time (end of the planning horizon)
     g.global_end_time = max([2 * move["endTime"] for entry in data["trains"] for move in entry["movements"]])
     g_block.global_end_time = g.global_end_time
-    types = {x["name"]: x for x in data["types"]}
+    train_numbers = list(range(1, len(data["trains"]) + 1))
+    if processes > 1 and len(train_numbers) > 1:
+        results = process_trains_in_parallel(data, g, g_block, train_numbers, processes)
+    else:
+        results = [process_train(data, train_number, g, g_block) for train_number in train_numbers]
     moves_per_agent = {}
     block_intervals = {}
-    for trainNumber, entry in enumerate(data["trains"]):
-        trainNumber += 1
-        measures = {}
-        measures["trainLength"] = sum([types[x]["length"] for x in entry["trainUnitTypes"]])
-        if len({types[i]["speed"] for i in entry["trainUnitTypes"]}) != 1:
-            logger.error("[ERROR] Not all train units have the same type")
-        measures["trainSpeed"] = types[entry["trainUnitTypes"][0]]["speed"] / 3.6
-        measures["walkingSpeed"] = data["walkingSpeed"]
-        measures["headwayFollowing"] = data["headwayFollowing"]
-        measures["headwayCrossing"] = data["headwayCrossing"]
-        measures["releaseTime"] = data["releaseTime"] if "releaseTime" in data else 0
-        measures["setupTime"] = data["setupTime"] if "setupTime" in data else 0
-        measures["sightReactionTime"] = data["sightReactionTime"] if "sightReactionTime" in data else 0
-        measures["minimumStopTime"] = data["minimumStopTime"] if "minimumStopTime" in data else 60
-        moves_per_agent[trainNumber] = []
-        block_intervals[trainNumber] = {e.get_identifier():[] for e in g_block.edges} | {n: [] for n in g_block.nodes}
-        # Each of the planned moves of the train must be converted to intervals
-        process_moves(entry, g, g_block, measures, moves_per_agent, block_intervals, trainNumber)
-    # Combine intervals and merge overlapping intervals, taking into account the current agent
-    block_intervals = combine_intervals_per_train(block_intervals, g_block, agent)
+    for trainNumber, result in zip(train_numbers, results):
+        moves_per_agent[trainNumber] = result.moves
+        block_intervals[trainNumber] = result.block_intervals
+        for e, departure_time in result.stops.items():
+            e.set_stop_at_station(trainNumber, departure_time)
+        for e, (cur_time, end_time, block_edge) in result.plotting_info.items():
+            e.set_plotting_info(trainNumber, cur_time, end_time, block_edge)
+    # Keep the routes found for this scenario for the next run on the same location
+    routes = route_table(g)
+    logger.info(f"Route table answered {routes.hits} of {routes.hits + routes.misses} lookups")
+    routes.save()
+    return block_intervals, moves_per_agent
+
+
+def check_intervals(block_intervals):
     for node in block_intervals:
         for i in range(len(block_intervals[node])):
             interval = block_intervals[node][i]
@@ -42,18 +64,112 @@ def process_scenario(data, g: TrackGraph, g_block: BlockGraph, agent):
                 logger.error(f"ERROR  node {node}: unsafe node interval {interval} has later end than start")
             if i > 0 and int(interval[0]) < int(block_intervals[node][i-1][1]):
                 logger.error(f"ERROR  node {node}: unsafe node interval {interval} has a start which comes before the end of previous interval {block_intervals[node][i-1]}")
-    return block_intervals, moves_per_agent
 
 
-def process_moves(entry, g, g_block, measures, moves_per_agent, block_intervals, trainNumber):
+def process_train(data, trainNumber, g: TrackGraph, g_block: BlockGraph) -> TrainResult:
+    """Process the moves of a train of the scenario, only reading the graphs."""
+    entry = data["trains"][trainNumber - 1]
+    types = {x["name"]: x for x in data["types"]}
+    measures = {}
+    measures["trainLength"] = sum([types[x]["length"] for x in entry["trainUnitTypes"]])
+    if len({types[i]["speed"] for i in entry["trainUnitTypes"]}) != 1:
+        logger.error("[ERROR] Not all train units have the same type")
+    measures["trainSpeed"] = types[entry["trainUnitTypes"][0]]["speed"] / 3.6
+    measures["walkingSpeed"] = data["walkingSpeed"]
+    measures["headwayFollowing"] = data["headwayFollowing"]
+    measures["headwayCrossing"] = data["headwayCrossing"]
+    measures["releaseTime"] = data["releaseTime"] if "releaseTime" in data else 0
+    measures["setupTime"] = data["setupTime"] if "setupTime" in data else 0
+    measures["sightReactionTime"] = data["sightReactionTime"] if "sightReactionTime" in data else 0
+    measures["minimumStopTime"] = data["minimumStopTime"] if "minimumStopTime" in data else 60
+    # A train only occupies a corridor of the layout, so only the blocks it uses get an entry
+    result = TrainResult(defaultdict(list), [], {}, {})
+    # Each of the planned moves of the train must be converted to intervals
+    process_moves(entry, g, g_block, measures, result, trainNumber)
+    return result
+
+
+def process_trains_in_parallel(data, g: TrackGraph, g_block: BlockGraph, train_numbers, processes) -> list[TrainResult]:
+    """
+    process_train for each of train_numbers on a process pool. The workers get a copy of the graphs and the route
+    table, their results refer to edges by index and are translated back to the edges of g and g_block. The routes the
+    workers found and their route table lookups are added to the route table of g.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from generation.GraphPickler import serialize_block_graph, serialize_track_graph
+
+    routes = route_table(g)
+    graphs = (serialize_track_graph(g), serialize_block_graph(g_block, g), [e.get_identifier() for e in g_block.edges],
+              g.global_end_time, dict(routes.travel_times), dict(routes.paths))
+    # Several chunks per process, so a few long trains do not keep the other processes waiting
+    chunk_size = max(1, -(-len(train_numbers) // (4 * processes)))
+    chunks = [train_numbers[i:i + chunk_size] for i in range(0, len(train_numbers), chunk_size)]
+    results = []
+    with ProcessPoolExecutor(processes, initializer=_init_train_worker, initargs=(graphs, data)) as pool:
+        for chunk_results, travel_times, paths, hits, misses in pool.map(_train_worker, chunks):
+            routes.add(travel_times, paths)
+            routes.hits += hits
+            routes.misses += misses
+            for block_intervals, moves, stops, plotting_info in chunk_results:
+                results.append(TrainResult(
+                    block_intervals,
+                    [[g.edges[i] for i in move] for move in moves],
+                    {g.edges[i]: departure_time for i, departure_time in stops},
+                    {g.edges[i]: (cur_time, end_time, g_block.edges[block]) for i, cur_time, end_time, block in plotting_info},
+                ))
+    return results
+
+
+_train_worker_state = None
+
+def _init_train_worker(graphs, data):
+    from generation.GraphPickler import deserialize_block_graph, deserialize_track_graph
+    from generation.route_table import RouteTable
+
+    global _train_worker_state
+    track, block, block_identifiers, global_end_time, travel_times, paths = graphs
+    g = deserialize_track_graph(track)
+    g_block = deserialize_block_graph(block, g)
+    g.global_end_time = g_block.global_end_time = global_end_time
+    g.routes = RouteTable(g)
+    g.routes.add(travel_times, paths)
+    # Edge ids are global counters, so the block edges of the copy have other identifiers than the originals
+    identifiers = dict(zip((e.get_identifier() for e in g_block.edges), block_identifiers))
+    _train_worker_state = (g, g_block, identifiers, data, set(travel_times), set(paths))
+
+def _train_worker(train_numbers):
+    g, g_block, identifiers, data, known_travel_times, known_paths = _train_worker_state
+    hits, misses = g.routes.hits, g.routes.misses
+    results = []
+    for train_number in train_numbers:
+        result = process_train(data, train_number, g, g_block)
+        results.append((
+            {identifiers.get(block, block): intervals for block, intervals in result.block_intervals.items()},
+            [[e.index for e in move] for move in result.moves],
+            [(e.index, departure_time) for e, departure_time in result.stops.items()],
+            [(e.index, cur_time, end_time, block_edge.index) for e, (cur_time, end_time, block_edge) in result.plotting_info.items()],
+        ))
+    # Send the routes found by this worker and the lookups of this chunk back, so they end up in the route table of
+    # the scenario
+    travel_times = {key: value for key, value in g.routes.travel_times.items() if key not in known_travel_times}
+    paths = {key: value for key, value in g.routes.paths.items() if key not in known_paths}
+    known_travel_times.update(travel_times)
+    known_paths.update(paths)
+    return results, travel_times, paths, g.routes.hits - hits, g.routes.misses - misses
+
+
+def process_moves(entry, g, g_block, measures, result: TrainResult, trainNumber):
     """Process the data for all moves. A move is defined by a start and end time and a start and end node. First the path is constructed, then the unsafe intervals for each node and edge in the path are generated."""
+    # The blocks of all moves of the train so far, like convertMovesToBlock joins them, each path is converted once
+    block_routes = []
+    tracks = signal_tracks(g)
     for i in range(len(entry["movements"])):
         move = entry["movements"][i]
         current_train = trainNumber # This is the train making the move, but not necessarily the delayed agent
-        path = construct_path(g, move, current_agent=current_train, agent_velocity=measures["trainSpeed"])
-        moves_per_agent[trainNumber].append(path)
-        block_routes = convertMovesToBlock(moves_per_agent, g, current_train)[current_train][0]
-        current_block_intervals = generate_unsafe_intervals(g_block, path, block_routes, move, measures, current_train)
+        path = construct_path(g, move, current_agent=current_train, agent_velocity=measures["trainSpeed"], stops_at_station=result.stops)
+        result.moves.append(path)
+        block_routes.extend(convertMoveToBlock(path, tracks))
+        current_block_intervals = generate_unsafe_intervals(g_block, path, block_routes, move, measures, current_train, result.stops, result.plotting_info)
 
         
         # # If train starts at a parking track node, it is unsafe until its start time
@@ -71,103 +187,136 @@ def process_moves(entry, g, g_block, measures, moves_per_agent, block_intervals,
         # If the train waits at a node, it is unsafe in between the two intervals
         for node in current_block_intervals:
             for tup in current_block_intervals[node]:
-                block_intervals[current_train][node].append(tup)
-    return block_intervals
-
-def calculate_heuristic(g: Graph, start: Node, agent_velocity):
-    time_distances = {n: sys.maxsize for n in g.nodes}
-    pq = Q.PriorityQueue()
-    time_distances[start.name] = 0
-    pq_counter = 0
-    # Use a counter so it doesn't have to compare nodes
-    pq.put((time_distances[start.name], pq_counter, start))
-    pq_counter += 1
-    # This does not include the other node intervals: this will have to be updated with propagating SIPP searches
-    logger.debug("Calculating Heuristic")
-    while not pq.empty():
-        v = pq.get()[2]
-        for e in v.incoming:
-            velocity = min(e.max_speed, agent_velocity)
-            tmp = time_distances[v.name] + (e.length / velocity)
-            if tmp < time_distances[e.from_node.name]:
-                time_distances[e.from_node.name] = tmp
-                pq.put((time_distances[e.from_node.name], pq_counter, e.from_node))
-                pq_counter += 1
-                logger.debug(f"time-distance to {e.from_node.name}: {tmp}")
-    return time_distances
-
-def distance_between_nodes(g: Graph, start: Node, end, agent_velocity):
-    time_distances = {n: sys.maxsize for n in g.nodes}
-    pq = Q.PriorityQueue()
-    time_distances[start.name] = 0
-    pq_counter = 0
-    # Use a counter so it doesn't have to compare nodes
-    pq.put((time_distances[start.name], pq_counter, start))
-    pq_counter += 1
-    # This does not include the other node intervals: this will have to be updated with propagating SIPP searches
-    while not pq.empty():
-        u = pq.get()[2]
-        for e in u.outgoing:
-            velocity = min(e.max_speed, agent_velocity)
-            tmp = time_distances[u.name] + (e.length / velocity)
-            v = e.to_node
-            if tmp < time_distances[v.name]:
-                time_distances[v.name] = tmp
-                if end is not None and v.name == end.name:
-                    return tmp
-                pq.put((time_distances[v.name], pq_counter, v))
-                pq_counter += 1
-    raise ValueError(f"No path found between {start} and {end}")
-
-def calculate_path(g, start, end):
-    distances = {n: sys.maxsize for n in g.nodes}
-    previous = {n: None for n in g.nodes}
-    previous_edge = {n: None for n in g.nodes}
-    pq = Q.PriorityQueue()
-    distances[start.name] = 0
-    pq_counter = 0
+                result.block_intervals[node].append(tup)
+    return result
+
+def shortest_paths(start: Node, targets=(), agent_velocity=None, reverse=False):
+    """
+    Dijkstra from start over the outgoing edges, or over the incoming edges when reverse is set.
+    An edge weighs its travel time at agent_velocity, or its length when no velocity is given.
+    The search stops once every node in targets is settled, without targets the whole graph is searched.
+    Returns the distances to the reached nodes and the last edge of the shortest path to them, keyed on node name.
+    """
+    if start._adjacency is not None:
+        return compact_shortest_paths(start._adjacency, start, targets, agent_velocity, reverse)
+    remaining = {n.name for n in targets}
+    distances = {start.name: 0}
+    previous_edges = {}
+    settled = set()
     # Use a counter so it doesn't have to compare nodes
-    pq.put((distances[start.name], pq_counter, start))
-    pq_counter += 1
-    # This does not include the other node intervals: this will have to be updated with propagating SIPP searches
-    while not pq.empty():
-        u = pq.get()[2]
-        for v in u.outgoing:
-            tmp = distances[u.name] + v.length
-            if tmp < distances[v.to_node.name]:
-                distances[v.to_node.name] = tmp
-                previous[v.to_node.name] = u
-                previous_edge[v.to_node.name] = v
-                pq.put((distances[v.to_node.name], pq_counter, v.to_node))
-                pq_counter += 1
+    heap = [(0, 0, start)]
+    counter = 1
+    while heap:
+        distance, _, u = heappop(heap)
+        if u.name in settled:
+            continue
+        settled.add(u.name)
+        remaining.discard(u.name)
+        if targets and not remaining:
+            break
+        for e in (u.incoming if reverse else u.outgoing):
+            v = e.from_node if reverse else e.to_node
+            if agent_velocity is None:
+                tmp = distance + e.length
+            else:
+                tmp = distance + e.length / min(e.max_speed, agent_velocity)
+            if tmp < distances.get(v.name, sys.maxsize):
+                distances[v.name] = tmp
+                previous_edges[v.name] = e
+                heappush(heap, (tmp, counter, v))
+                counter += 1
+    for name in remaining:
+        distances.pop(name, None)
+    profiler.count("dijkstra_calls")
+    profiler.count("dijkstra_settled", len(settled))
+    return distances, previous_edges
+
+def compact_shortest_paths(csr: CSRAdjacency, start: Node, targets=(), agent_velocity=None, reverse=False):
+    """shortest_paths on the CSR arrays of a compact graph, the nodes are addressed by index until the search ends."""
+    offsets, neighbours, edge_indices, weights = csr.search_arrays(agent_velocity, reverse)
+    remaining = {n.index for n in targets}
+    distances = {start.index: 0}
+    previous_edges = {}
+    settled = set()
+    heap = [(0, 0, start.index)]
+    counter = 1
+    while heap:
+        distance, _, u = heappop(heap)
+        if u in settled:
+            continue
+        settled.add(u)
+        remaining.discard(u)
+        if targets and not remaining:
+            break
+        for i in range(offsets[u], offsets[u + 1]):
+            v = neighbours[i]
+            tmp = distance + weights[i]
+            if tmp < distances.get(v, sys.maxsize):
+                distances[v] = tmp
+                # The position of the edge in the arrays, its index is only looked up for the reached nodes
+                previous_edges[v] = i
+                heappush(heap, (tmp, counter, v))
+                counter += 1
+    for index in remaining:
+        distances.pop(index, None)
+    profiler.count("dijkstra_calls")
+    profiler.count("dijkstra_settled", len(settled))
+    nodes, edges = csr.nodes, csr.edges
+    return ({nodes[v].name: distance for v, distance in distances.items()},
+            {nodes[v].name: edges[edge_indices[i]] for v, i in previous_edges.items()})
+
+def path_to(previous_edges, start: Node, end: Node) -> list[TrackEdge]:
+    """The edges from start to end following the predecessor edges of a shortest_paths search from start."""
     path = []
     current = end
-    try:
-        while current != start:
-            for x in current.incoming:
-                if x.from_node == previous[current.name]:
-                    path.insert(0, x)
-            current = previous[current.name]
-    except Exception as e:
-        logger.error(f"##### ERROR ### {e} No path was found between {start.name} and {end.name}")
+    while current.name != start.name:
+        if current.name not in previous_edges:
+            logger.error(f"##### ERROR ### No path was found between {start.name} and {end.name}")
+            return []
+        path.append(previous_edges[current.name])
+        current = path[-1].from_node
+    path.reverse()
     return path
 
+def calculate_heuristic(g: Graph, start: Node, agent_velocity):
+    # This does not include the other node intervals: this will have to be updated with propagating SIPP searches
+    logger.debug("Calculating Heuristic")
+    time_distances, _ = shortest_paths(start, agent_velocity=agent_velocity, reverse=True)
+    return {n: time_distances.get(n, sys.maxsize) for n in g.nodes}
+
+def distances_between_nodes(start: Node, ends, agent_velocity) -> list[float]:
+    """Travel times from start to each of ends, in a single search."""
+    time_distances, _ = shortest_paths(start, ends, agent_velocity)
+    for end in ends:
+        if end.name not in time_distances:
+            raise ValueError(f"No path found between {start} and {end}")
+    return [time_distances[end.name] for end in ends]
+
+def distance_between_nodes(g: TrackGraph, start: Node, end, agent_velocity):
+    return route_table(g).distance(start, end, agent_velocity)
+
+def calculate_path(g: TrackGraph, start, end):
+    return route_table(g).path(start, end)
+
 def get_initial_direction(g: Graph, start, end, agent_velocity):
     start_a, start_b = start
     end_a, end_b = end
     start_a, start_b, end_a, end_b = g.nodes[start_a], g.nodes[start_b], g.nodes[end_a], g.nodes[end_b]
-    length_aa = distance_between_nodes(g, start_a, end_a, agent_velocity)
-    length_ab = distance_between_nodes(g, start_a, end_b, agent_velocity)
-    length_ba = distance_between_nodes(g, start_b, end_a, agent_velocity)
-    length_bb = distance_between_nodes(g, start_b, end_b, agent_velocity)
+    routes = route_table(g)
+    # One search per start side, the first leg of construct_path reuses these distances
+    length_aa, length_ab = routes.distances(start_a, [end_a, end_b], agent_velocity)
+    length_ba, length_bb = routes.distances(start_b, [end_a, end_b], agent_velocity)
     logger.debug(f"Shortest distance side: aa: {length_aa}, ab: {length_ab}, ba: {length_ba}, bb: {length_bb}")
     min_length = min(length_aa, length_ab, length_ba, length_bb)
     if min_length in [length_aa, length_ab]:
         return 0
     return 1
 
-def construct_path(g: Graph, move, print_path_error=True, current_agent=0, agent_velocity=15):
-    """Construct a shortest path from the start to the end location to determine the locations and generate their unsafe intervals."""
+def construct_path(g: Graph, move, print_path_error=True, current_agent=0, agent_velocity=15, stops_at_station=None):
+    """
+    Construct a shortest path from the start to the end location to determine the locations and generate their unsafe intervals.
+    The departure times at the stops are recorded in stops_at_station per track edge, or on the edges themselves without it.
+    """
     start = g.get_station(move["startLocation"])
     old_stops = move["stops"]
     departure_times = {}
@@ -181,37 +330,58 @@ def construct_path(g: Graph, move, print_path_error=True, current_agent=0, agent
     all_movements = [start] + stops + [end]
     logger.debug(f"Finding path via {all_movements}")
     path = []
+    # Timetables reuse the same platform pairs, so the distances and routes come from the route table of the graph
+    routes = route_table(g)
     direction = get_initial_direction(g, all_movements[0], all_movements[1], agent_velocity)
     for i in range(len(all_movements) - 1):
         start = g.nodes[all_movements[i][direction]]
         end_a = g.nodes[all_movements[i + 1][0]]
         end_b = g.nodes[all_movements[i + 1][1]]
-        dist_a = distance_between_nodes(g, start, end_a, agent_velocity)
-        dist_b = distance_between_nodes(g, start, end_b, agent_velocity)
+        dist_a, dist_b = routes.distances(start, [end_a, end_b], agent_velocity)
         if dist_a <= dist_b:
-            next_path = calculate_path(g, start, end_a)
+            next_path = routes.path(start, end_a)
             direction = 0
         else:
-            next_path = calculate_path(g, start, end_b)
+            next_path = routes.path(start, end_b)
             direction = 1
-        if next_path and i != 0:
-            next_path[0].stops_at_station[current_agent] = departure_times[all_movements[i]]
+        if next_path and i != 0 and stops_at_station is not None:
+            stops_at_station[next_path[0]] = departure_times[all_movements[i]]
+        elif next_path and i != 0:
+            next_path[0].set_stop_at_station(current_agent, departure_times[all_movements[i]])
         path.extend(next_path)
 
     return path
 
-def calculate_blocking_time(e: TrackEdge, cur_time, blocking_intervals, measures, current_train, path: list[BlockEdge]):
+def block_path_positions(path: list[BlockEdge]) -> dict[str, int]:
+    """Index in path of the first block each track node belongs to, keyed on the name of the track node."""
+    positions = {}
+    for i, block in enumerate(path):
+        for tn in block.tracknodes(Direction.SAME):
+            positions.setdefault(tn.name, i)
+    return positions
+
+def calculate_blocking_time(e: TrackEdge, cur_time, blocking_intervals, measures, current_train, path: list[BlockEdge], positions=None, approach_blocks=None, stops_at_station=None, plotting_info=None):
+    """
+    positions are the block_path_positions of path, approach_blocks caches the blocks approached from each index in
+    path. Both are shared by the edges of a path, so each block of the path is only looked at once.
+    stops_at_station and plotting_info hold the departure times and plotting information of the train per track edge,
+    without them these are read from and written to the edges.
+    """
+    if stops_at_station is None:
+        departure_time = e.stops_at_station.get(current_train)
+    else:
+        departure_time = stops_at_station.get(e)
 
     station_time = 0
-    if current_train in e.stops_at_station:
-        station_time = e.stops_at_station[current_train] - cur_time
+    if departure_time is not None:
+        station_time = departure_time - cur_time
 
     train_speed = min(e.max_speed, measures["trainSpeed"])
     clearing_time = measures["trainLength"] / train_speed
     end_occupation_time = cur_time + e.length / train_speed + clearing_time + station_time
 
     # Recovery time calculation
-    if current_train in e.stops_at_station:
+    if departure_time is not None:
         recovery_time = max(0, station_time - measures["minimumStopTime"])
     else:
         recovery_time = (e.length / train_speed) - e.length / (train_speed * 1.08)
@@ -235,13 +405,14 @@ def calculate_blocking_time(e: TrackEdge, cur_time, blocking_intervals, measures
     N_BLOCKS = 2
 
     # Find current spot in block graph
-    bools = [e.from_node in block.tracknodes(Direction.SAME) for block in path]
-    current_path_index = bools.index(True) if True in bools else None
+    if positions is None:
+        positions = block_path_positions(path)
+    if approach_blocks is None:
+        approach_blocks = {}
+    current_path_index = positions.get(e.from_node.name)
 
-    if current_path_index is not None:
-        logger.debug(f"Edge {e} belongs to block: {path[current_path_index]}")
-    else:
-        logger.debug(f"Edge {e} does not belong to any block in path: {path}")
+    if tracer.enabled:
+        tracer.emit("block_position", train=current_train, edge=e, block=None if current_path_index is None else path[current_path_index])
 
     next_blocks_approach_time = (start_approach_time,
                      end_approach_time,
@@ -250,25 +421,27 @@ def calculate_blocking_time(e: TrackEdge, cur_time, blocking_intervals, measures
                      0.0
     )
 
-    approach_blocks = set()
-
-    if current_path_index is not None:
-        for path_block in path[current_path_index:current_path_index + N_BLOCKS]:
-            for tn in path_block.tracknodes(Direction.BOTH):
-                for block in tn.blocks(Direction.BOTH):
-                    approach_blocks.add(block.get_identifier())
-
-    for block in approach_blocks:
-        blocking_intervals[block].append(next_blocks_approach_time)
-
     if current_path_index is not None:
+        if current_path_index not in approach_blocks:
+            approach_blocks[current_path_index] = {block.get_identifier()
+                                                   for path_block in path[current_path_index:current_path_index + N_BLOCKS]
+                                                   for tn in path_block.tracknodes(Direction.BOTH)
+                                                   for block in tn.blocks(Direction.BOTH)}
+        for block in approach_blocks[current_path_index]:
+            blocking_intervals[block].append(next_blocks_approach_time)
+
+    if current_path_index is not None and plotting_info is not None:
+        plotting_info[e] = (cur_time, end_approach_time, path[current_path_index])
+    elif current_path_index is not None:
         e.set_plotting_info(current_train, cur_time, end_approach_time, path[current_path_index])
 
     return end_approach_time
 
-def generate_unsafe_intervals(g_block, path: list[TrackEdge], block_path: list[BlockEdge], move, measures, current_train):
+def generate_unsafe_intervals(g_block, path: list[TrackEdge], block_path: list[BlockEdge], move, measures, current_train, stops_at_station=None, plotting_info=None):
     cur_time = move["startTime"]
-    block_intervals = {e.get_identifier():[] for e in g_block.edges} | {n: [] for n in g_block.nodes}
+    block_intervals = defaultdict(list)
+    positions = block_path_positions(block_path)
+    approach_blocks = {}
     for e in path:
         # If the train reverses: going from an A to B side -> use walking speed
         # if ("A" in e.from_node.name and "B" in e.to_node.name) or ("B" in e.from_node.name and "A" in e.to_node.name):
@@ -279,45 +452,73 @@ def generate_unsafe_intervals(g_block, path: list[TrackEdge], block_path: list[B
         #     cur_time = end_time
         # In all other cases use train speed
         # else:
-            end_time = calculate_blocking_time(e, cur_time, block_intervals, measures, current_train, block_path)
+            end_time = calculate_blocking_time(e, cur_time, block_intervals, measures, current_train, block_path, positions, approach_blocks, stops_at_station, plotting_info)
             # Time train leaves the node
             cur_time = end_time
     return block_intervals
 
 def combine_intervals(intervals, combined, agent):
-    for train in intervals:
-        for n in intervals[train]:
-            intervals[train][n].sort()
-            for tup in intervals[train][n]:
-                double = False
-                for x in combined[n]:
-                    # If the new (tup) fits in existing (x)
-                    if tup[0] >= x[0] and tup[0] <= x[1] and tup[1] <= x[1] and tup[1] >= x[0]:
-                        double = True
-                    # if the existing (x) fits in the new (tup) -> replace
-                    elif x[0] >= tup[0] and x[0] <= tup[1] and x[1] <= tup[1] and x[1] >= tup[0]:
-                        combined[n].remove(x)
-                if not double:
-                    if train != int(agent):
-                        combined[n].append(tup)
+    """
+    Add the intervals of all trains except agent to combined, leaving out the intervals that fit in another one.
+    Of equal intervals the first one is kept, in the order of the trains. Without agent all trains are added.
+    """
+    excluded = None if agent is None else int(agent)
+    # Gather the intervals of each block from the blocks the trains occupy, in the order of the trains
+    gathered = {}
+    for train, blocks in intervals.items():
+        if train == excluded:
+            continue
+        for n, tups in blocks.items():
+            if n in combined:
+                gathered.setdefault(n, []).extend(sorted(tups))
+    for n, occupations in gathered.items():
+        # Sweep by start, a longer interval comes first so the intervals it contains come after it
+        occupations.sort(key=lambda tup: (tup[0], -tup[1]))
+        latest_end = -float("inf")
+        for tup in occupations:
+            if tup[1] > latest_end:
+                combined[n].append(tup)
+                latest_end = tup[1]
+
+def merge_intervals(intervals: list[tuple]) -> list[tuple]:
+    """
+    Merge each interval of a sorted list with the next ones that start before it ends, in a single pass. The merged
+    interval runs from the first start to the last end, has the train of the last interval and the summed duration and
+    recovery time.
+    """
+    merged = []
+    if not intervals:
+        return merged
+    start, end, duration, train, recovery = intervals[0]
+    for interval in intervals[1:]:
+        # As the list is sorted and contains no subcontained interval, we can simply check for overlap.
+        if interval[0] <= end:
+            end, duration, train, recovery = interval[1], interval[2] + duration, interval[3], interval[4] + recovery
+        else:
+            merged.append((start, end, duration, train, recovery))
+            start, end, duration, train, recovery = interval
+    merged.append((start, end, duration, train, recovery))
+    profiler.count("intervals_merged", len(intervals) - len(merged))
+    return merged
 
 def sort_and_merge(combined):
     for n in combined:
         combined[n].sort()
-        i = 0
-        while i < len(combined[n]) - 1:
-            # As list is sorted and contains no subcontained interval, we can simply check for overlap.
-            if combined[n][i+1][0] <= combined[n][i][1]:
-                duration = combined[n][i+1][2] + combined[n][i][2]
-                recovery = combined[n][i+1][4] + combined[n][i][4]
-                # Replace the two intervals with one combined interval
-                new_interval = (combined[n][i][0], combined[n][i+1][1], duration, combined[n][i+1][3], recovery)
-                combined[n].remove(combined[n][i+1])
-                combined[n].remove(combined[n][i])
-                combined[n].insert(i, new_interval)
-            else:
-                i += 1
-
+        combined[n] = merge_intervals(combined[n])
+
+@profiled("combine_intervals_without_agent")
+def combine_intervals_without_agent(block_intervals, combined, agent):
+    """
+    The combined intervals of all trains but agent, from the combined intervals of all trains. Only the blocks that
+    agent occupies are combined again, the other blocks share their lists with combined. Returns the intervals and the
+    blocks that were combined again.
+    """
+    changed = {n: [] for n in block_intervals[agent]}
+    combine_intervals(block_intervals, changed, agent)
+    sort_and_merge(changed)
+    return combined | changed, set(changed)
+
+@profiled("combine_intervals_per_train")
 def combine_intervals_per_train(block_intervals, g_block, agent=None):
     """Combine the intervals for individual trains together per node/edge and remove duplicates/overlap."""
     combined_blocks = {e.get_identifier(): [] for e in g_block.edges} | {n: [] for n in g_block.nodes}
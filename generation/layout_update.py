@@ -0,0 +1,174 @@
+from collections import deque
+from logging import getLogger
+
+from generation.graph import TrackGraph, BlockGraph, BlockNode, Signal, TrackNode
+from generation.util import add_track_nodes, connect_track_part, opposite_edges, track_connections, track_part_nodes
+
+logger = getLogger('__main__.' + __name__)
+
+
+def apply_layout_delta(g: TrackGraph, g_block: BlockGraph, delta, processes=1):
+    """
+    Apply an edit of the layout to a track graph and its block graph, without rebuilding them from scratch.
+    The delta uses the format of a location file: the "trackParts", "signals" and "stations" in it are added, or replace
+    the track part with the same id, the signal with the same name or the station on the same platform. A change of the
+    connections of a track part is a replacement of that track part. "removedTrackParts" holds the ids of the track
+    parts to remove, "removedSignals" the names of the signals to remove.
+    Only the track parts that changed and their neighbours are reconnected, and only the blocks of the signals from
+    which a changed track is reachable are searched again. Returns the names of these signals.
+    """
+    compact = g.csr is not None or g_block.csr is not None
+    g.expand()
+    g_block.expand()
+
+    parts = [track_connections(track) for track in delta.get("trackParts", [])]
+    removed_parts = set(delta.get("removedTrackParts", []))
+    changed_parts = removed_parts | {track.id for track in parts}
+    new_signals = {signal["name"]: signal for signal in delta.get("signals", [])}
+    removed_signals = set(delta.get("removedSignals", []))
+
+    # Nodes of the changed track parts are replaced, the neighbours of these parts get new outgoing edges
+    old_nodes = [g.nodes[name] for track_id in changed_parts if track_id in g.track_parts
+                 for name in sum(track_part_nodes(g, g.track_parts[track_id]), [])]
+    reconnected_parts = neighbouring_parts(g, changed_parts, old_nodes) - changed_parts
+    reconnected_nodes = [g.nodes[name] for track_id in reconnected_parts
+                         for name in sum(track_part_nodes(g, g.track_parts[track_id]), [])]
+
+    old_signals = {signal.id: signal for signal in g.signals}
+    moved_signals = [old_signals[name] for name in removed_signals | new_signals.keys() if name in old_signals]
+    affected_signals = reaching_signals(old_nodes + reconnected_nodes + [s.track for s in moved_signals], g.signals)
+
+    # Replace the changed track parts
+    removed_edges = [e for node in reconnected_nodes for e in node.outgoing]
+    removed_edges += [e for node in old_nodes for e in node.outgoing + node.incoming]
+    g.remove_nodes(old_nodes)
+    g.remove_edges(removed_edges)
+    for track_id in removed_parts:
+        g.track_parts.pop(track_id, None)
+    nodes_per_id_A = {}
+    nodes_per_id_B = {}
+    for track in delta.get("trackParts", []):
+        g.track_parts[track["id"]] = track_connections(track)
+        add_track_nodes(g, track, nodes_per_id_A, nodes_per_id_B)
+    for track in parts:
+        for track_id in [*track.aSide, *track.bSide]:
+            if track_id in g.track_parts and track_id not in nodes_per_id_A:
+                nodes_per_id_A[track_id], nodes_per_id_B[track_id] = track_part_nodes(g, g.track_parts[track_id])
+    for track_id in reconnected_parts:
+        for neighbour in [track_id, *g.track_parts[track_id].aSide, *g.track_parts[track_id].bSide]:
+            if neighbour in g.track_parts and neighbour not in nodes_per_id_A:
+                nodes_per_id_A[neighbour], nodes_per_id_B[neighbour] = track_part_nodes(g, g.track_parts[neighbour])
+    # read_graph only knows the ids of track parts that have nodes
+    nodes_per_id_A = {track_id: nodes for track_id, nodes in nodes_per_id_A.items() if nodes}
+    nodes_per_id_B = {track_id: nodes for track_id, nodes in nodes_per_id_B.items() if nodes}
+    first_new_edge = len(g.edges)
+    for track_id, track in g.track_parts.items():
+        if track_id in reconnected_parts or (track_id in changed_parts and track_id in nodes_per_id_A):
+            connect_track_part(g, track, nodes_per_id_A, nodes_per_id_B)
+
+    # The opposites of an edge are the edges between the opposites of its end nodes
+    new_nodes = [g.nodes[name] for track in parts if track.id in nodes_per_id_A
+                 for name in nodes_per_id_A[track.id] + nodes_per_id_B[track.id]]
+    changed_nodes = {id(n): n for n in new_nodes + reconnected_nodes}
+    changed_nodes.update((id(n), n) for e in removed_edges + g.edges[first_new_edge:] for n in (e.from_node, e.to_node)
+                         if g.nodes.get(n.name) is n)
+    changed_nodes.update((id(o), o) for n in list(changed_nodes.values()) for o in n.opposites)
+    for e in {e for n in changed_nodes.values() for e in n.outgoing + n.incoming}:
+        e.opposites = opposite_edges(e)
+
+    # Signals on replaced nodes move to the new node with the same name, unless that node no longer exists
+    signals = []
+    for signal in g.signals:
+        if signal.id in removed_signals or signal.id in new_signals:
+            continue
+        if g.nodes.get(signal.track.name) is not signal.track:
+            if signal.track.name not in g.nodes:
+                logger.warning(f"Removing signal {signal.id}, its track {signal.track} was removed")
+                removed_signals.add(signal.id)
+                continue
+            signal = Signal(signal.id, g.nodes[signal.track.name])
+            moved_signals.append(signal)
+        signals.append(signal)
+    for name, signal in new_signals.items():
+        track_nodes = track_part_nodes(g, g.track_parts[signal["track"]])
+        signals.append(Signal(name, g.nodes[track_nodes[0 if signal["side"] == "A" else 1][0]]))
+        moved_signals.append(signals[-1])
+    g.signals = signals
+    g.signal_tracks = None
+
+    for station in delta.get("stations", []):
+        track_nodes = track_part_nodes(g, g.track_parts[station["trackId"]])
+        g.stations[f"{station['stationName'].upper()}|{station['platform']}"] = (track_nodes[0][0], track_nodes[1][0])
+    for station, (node_a, node_b) in list(g.stations.items()):
+        if node_a not in g.nodes or node_b not in g.nodes:
+            logger.warning(f"Removing station {station}, its track was removed")
+            del g.stations[station]
+
+    # Search the blocks again of every signal that reached a changed track before or after the edit
+    signal_tracks = [g.nodes[s.track.name] for s in moved_signals if s.track.name in g.nodes]
+    affected_signals |= reaching_signals(list(changed_nodes.values()) + signal_tracks, g.signals)
+    removed_blocks = []
+    for signal in old_signals.values():
+        if signal.id in affected_signals and f"r-{signal.id}" in g_block.nodes:
+            block = g_block.nodes[f"r-{signal.id}"]
+            removed_blocks.extend(block.outgoing)
+            signal.track.blk = [x for x in signal.track.blk if x is not block]
+    g_block.remove_edges(removed_blocks)
+    g_block.remove_nodes([g_block.nodes[f"r-{name}"] for name in removed_signals - new_signals.keys()
+                          if f"r-{name}" in g_block.nodes])
+    for signal in g.signals:
+        if signal.id in affected_signals or signal.id in new_signals:
+            block = g_block.nodes.get(f"r-{signal.id}") or g_block.add_node(BlockNode(f"r-{signal.id}"))
+            signal.track.blk.append(block)
+    rebuilt_signals = [signal for signal in g.signals if signal.id in affected_signals or signal.id in new_signals]
+    g_block.add_signal_blocks(g, rebuilt_signals, processes)
+    g_block.map_stations(g)
+
+    # Routes refer to edges by index and the persisted table belongs to the unedited location file
+    g.routes = None
+    if compact:
+        g.compact()
+        g_block.compact()
+    logger.info(f"Layout edit rebuilt the blocks of {len(rebuilt_signals)} of {len(g.signals)} signals")
+    return [signal.id for signal in rebuilt_signals]
+
+
+def neighbouring_parts(g: TrackGraph, track_ids, nodes: list[TrackNode]) -> set:
+    """Ids of the track parts that connect to one of track_ids, or have an edge to or from one of nodes."""
+    track_ids = set(track_ids)
+    neighbours = {track.id for track in g.track_parts.values() if track_ids.intersection(track.aSide, track.bSide)}
+    # Node names are the name of their track part followed by the side, A, B, AR, AL, BR or BL
+    part_ids = {track.name: track.id for track in g.track_parts.values()}
+    for node in nodes:
+        for n in [*(e.from_node for e in node.incoming), *(e.to_node for e in node.outgoing)]:
+            track_id = part_ids.get(n.name[:-1], part_ids.get(n.name[:-2]))
+            if track_id is not None:
+                neighbours.add(track_id)
+    return neighbours
+
+
+def reaching_signals(nodes: list[TrackNode], signals: list[Signal]) -> set:
+    """
+    Names of the signals whose block search reaches one of nodes. The search runs backwards from the nodes and stops
+    at the tracks of signals, like the block search itself stops there.
+    """
+    signal_tracks = {}
+    for signal in signals:
+        signal_tracks.setdefault(signal.track.name, []).append(signal.id)
+    found = set()
+    seen = {n.name for n in nodes}
+    queue = deque(nodes)
+    for node in nodes:
+        found.update(signal_tracks.get(node.name, []))
+    while queue:
+        node = queue.popleft()
+        for e in node.incoming:
+            previous = e.from_node
+            if previous.name in seen:
+                continue
+            seen.add(previous.name)
+            if previous.name in signal_tracks:
+                found.update(signal_tracks[previous.name])
+            else:
+                queue.append(previous)
+    return found
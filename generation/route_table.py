@@ -0,0 +1,94 @@
+from collections import OrderedDict
+from logging import getLogger
+
+from generation.graph import TrackEdge, TrackGraph
+
+logger = getLogger('__main__.' + __name__)
+
+# Entries per kind (travel times, routes), far more than the station pairs of a timetable
+MAX_ROUTES = 100_000
+
+
+class RouteTable:
+    """
+    Travel times and routes between the sides of stations of a track graph, computed on first use.
+    Travel times are keyed on (start node, end node, speed), routes on (start node, end node) since the route is the
+    shortest by length whatever the speed. Routes are stored as indices into the edges of the graph, so the table can
+    be persisted next to the graph cache.
+    Both are bounded by max_size, the least recently used entries are dropped first. hits and misses count the lookups
+    answered from the table and the ones that needed a search.
+    """
+    def __init__(self, g: TrackGraph, filename=None, max_size=MAX_ROUTES):
+        self.g = g
+        self.filename = filename
+        self.max_size = max_size
+        self.travel_times: OrderedDict[tuple[str, str, float], float] = OrderedDict()
+        self.paths: OrderedDict[tuple[str, str], tuple[int, ...]] = OrderedDict()
+        self.modified = False
+        self.hits = 0
+        self.misses = 0
+
+    def distance(self, start, end, agent_velocity) -> float:
+        return self.distances(start, [end], agent_velocity)[0]
+
+    def distances(self, start, ends, agent_velocity) -> list[float]:
+        """Travel times from start to each of ends, the ones not in the table are found in a single search."""
+        keys = [(start.name, end.name, agent_velocity) for end in ends]
+        missing = [end for end, key in zip(ends, keys) if key not in self.travel_times]
+        self.hits += len(ends) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            from generation.interval_generation import distances_between_nodes
+            for end, distance in zip(missing, distances_between_nodes(start, missing, agent_velocity)):
+                self.travel_times[(start.name, end.name, agent_velocity)] = distance
+            self.modified = True
+        result = []
+        for key in keys:
+            self.travel_times.move_to_end(key)
+            result.append(self.travel_times[key])
+        self.evict(self.travel_times)
+        return result
+
+    def path(self, start, end) -> list[TrackEdge]:
+        key = (start.name, end.name)
+        if key in self.paths:
+            self.hits += 1
+            self.paths.move_to_end(key)
+            route = self.paths[key]
+        else:
+            self.misses += 1
+            from generation.interval_generation import path_to, shortest_paths
+            _, previous_edges = shortest_paths(start, [end])
+            route = self.paths[key] = tuple(e.index for e in path_to(previous_edges, start, end))
+            self.modified = True
+            self.evict(self.paths)
+        edges = self.g.edges
+        return [edges[i] for i in route]
+
+    def add(self, travel_times, paths):
+        """Add travel times and routes found elsewhere, e.g. by the workers of a process pool."""
+        if travel_times or paths:
+            self.travel_times.update(travel_times)
+            self.paths.update(paths)
+            self.modified = True
+            self.evict(self.travel_times)
+            self.evict(self.paths)
+
+    def evict(self, entries: OrderedDict):
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+
+    def save(self):
+        """Write the table to its file if routes were added since it was read, tables without a file are not kept."""
+        if self.filename is None or not self.modified:
+            return
+        from generation.GraphPickler import dump_route_table
+        dump_route_table(self.filename, self)
+        self.modified = False
+
+
+def route_table(g: TrackGraph) -> RouteTable:
+    """The route table of g, an empty one is created in memory when the graph was not read from the cache."""
+    if g.routes is None:
+        g.routes = RouteTable(g)
+    return g.routes
@@ -1,32 +1,50 @@
 from logging import getLogger
 
 from generation.graph import Edge, TrackGraph, BlockEdge, Direction
+from generation.instrumentation import profiled
+from generation.trace import get_tracer
 
 logger = getLogger('__main__.' + __name__)
+tracer = get_tracer("block_routes")
 
+def signal_tracks(g: TrackGraph) -> set:
+    """The track nodes of the signals of g, built once and kept on the graph until the signals change."""
+    if g.signal_tracks is None:
+        g.signal_tracks = {signal.track for signal in g.signals}
+    return g.signal_tracks
+
+def convertMoveToBlock(movements, signal_tracks) -> list[BlockEdge]:
+    """The blocks of one movement, a block ends at each track edge that enters a signal track."""
+    block_route = []
+    blocks = None
+    for move in movements:
+        if blocks is None:
+            blocks = {block for block in move.to_node.blocks(Direction.SAME) if isinstance(block, Edge)}
+        blocks = blocks & {block for block in move.to_node.blocks(Direction.SAME) if isinstance(block, Edge)}
+        if tracer.enabled:
+            tracer.emit("move", move=move, blocks=blocks)
+        if move.to_node in signal_tracks:
+            if len(blocks) == 0:
+                raise ValueError(f"No valid block found for last move {move}")
+            if len(blocks) > 1:
+                logger.error(f"Should really only be one, {blocks}")
+            block_route.append(list(blocks)[0])
+            blocks = None
+        elif len(blocks) == 0:
+            raise ValueError(f"Should really only be one, {blocks}")
+    return block_route
+
+@profiled("convertMovesToBlock")
 def convertMovesToBlock(moves_per_agent, g: TrackGraph, agent=None) -> dict[int, list[BlockEdge]]:
     block_routes = {}
-    signal_tracks = {signal.track for signal in g.signals}
+    tracks = signal_tracks(g)
     if agent is not None:
         moves_per_agent = {agent: moves_per_agent[agent]}
     for agent in moves_per_agent:
-        logger.debug(f"Converting moves to block for {agent}.")
         block_route = []
         for movements in moves_per_agent[agent]:
-            blocks = None
-            for move in movements:
-                if blocks is None:
-                    blocks = {block for block in move.to_node.blocks(Direction.SAME) if isinstance(block, Edge)}
-                blocks = blocks & {block for block in move.to_node.blocks(Direction.SAME) if isinstance(block, Edge)}
-                logger.debug(f"Move: {move}, blocks possible {blocks}")
-                if move.to_node in signal_tracks:
-                    if len(blocks) == 0:
-                        raise ValueError(f"No valid block found for last move {move}")
-                    if len(blocks) > 1:
-                        logger.error(f"Should really only be one, {blocks}")
-                    block_route.append(list(blocks)[0])
-                    blocks = None
-                elif len(blocks) == 0:
-                    raise ValueError(f"Should really only be one, {blocks}")
+            block_route.extend(convertMoveToBlock(movements, tracks))
         block_routes[agent] = [block_route]
-    return block_routes
\ No newline at end of file
+        if tracer.enabled:
+            tracer.emit("block_route", train=agent, blocks=block_route)
+    return block_routes
@@ -0,0 +1,59 @@
+import json
+import atexit
+
+# The stages with trace points, in the order of the generation
+STAGES = ("blocks", "unsafe_intervals", "block_routes", "safe_intervals")
+
+
+class Tracer:
+    """
+    The trace points of one stage. A trace point is guarded by the enabled flag, so a disabled stage costs one
+    attribute check and builds no message:
+
+        if tracer.enabled:
+            tracer.emit("atf", from_state=from_index, to_state=to_index)
+
+    Enabled trace points write one json record per call to the trace file, with the stage, the name of the point and
+    the given fields.
+    """
+    def __init__(self, stage):
+        self.stage = stage
+        self.enabled = False
+        self.file = None
+
+    def emit(self, point, **fields):
+        self.file.write(json.dumps({"stage": self.stage, "point": point} | fields, default=str) + "\n")
+
+
+tracers = {stage: Tracer(stage) for stage in STAGES}
+
+
+def get_tracer(stage) -> Tracer:
+    return tracers[stage]
+
+
+def enable_tracing(stages, filename):
+    """Write the trace points of stages, names from STAGES or "all", to filename."""
+    stages = [stage.strip() for stage in stages]
+    if "all" in stages:
+        stages = STAGES
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown trace stages {sorted(unknown)}, choose from {', '.join(STAGES)} or all")
+    disable_tracing()
+    # Line buffered, so the workers of a process pool write whole records and never repeat buffered ones
+    file = open(filename, "wt", buffering=1)
+    for stage in stages:
+        tracers[stage].file = file
+        tracers[stage].enabled = True
+    atexit.unregister(disable_tracing)
+    atexit.register(disable_tracing)
+
+
+def disable_tracing():
+    files = {tracer.file for tracer in tracers.values() if tracer.file is not None}
+    for tracer in tracers.values():
+        tracer.enabled = False
+        tracer.file = None
+    for file in files:
+        file.close()
@@ -1,187 +1,311 @@
-import json 
+import re
+import json
+from collections import namedtuple
 from logging import getLogger
 from pathlib import Path
 
 from generation.graph import TrackGraph, Signal, TrackNode, TrackEdge
+from generation.instrumentation import profiled
 
 logger = getLogger('__main__.' + __name__)
 
-def read_graph(file) -> TrackGraph:
-    try:
-        base_path = Path(__file__).parent
-        file_path = (base_path / file).resolve()
-        data = json.load(open(file_path))
-    except:
-        data = json.load(open(file))
-    g = TrackGraph(file)
-    nodes_per_id_A = {}
-    nodes_per_id_B = {}
-    track_lengths = {}
-    for track in data["trackParts"]:
-        track_lengths[track["id"]] = track["length"]
-        side_switch_track_side  = track["type"] == "SideSwitch" and (len(track["aSide"]) == 1 or len(track["bSide"]) == 1)
-        side_switch_switch_side = track["type"] == "SideSwitch" and (len(track["aSide"]) == 2 or len(track["bSide"]) == 2)
-        if track["type"] in {"RailRoad", "Bumper"} or side_switch_track_side:
-            a = g.add_node(TrackNode(track["name"] + "A", track["type"]))
-            b = g.add_node(TrackNode(track["name"] + "B", track["type"]))
-            if track["stationPlatform"]:
-                a.stationPlatform = True
-                b.stationPlatform = True
-            # A/B nodes are associated because the have the same interval on the node if train can reverse
-            if track["sawMovementAllowed"]:
-                a.associated.append(b)
-                b.associated.append(a)
-                a.canReverse = True
-                b.canReverse = True
-            # A/B nodes are opposite because they have opposite edges attaches
-            a.opposites.append(b)
-            b.opposites.append(a)
-            nodes_per_id_A[track["id"]] = [track["name"] + "A"]
-            nodes_per_id_B[track["id"]] = [track["name"] + "B"]
-        # Nodes on the same side of a switch are not associated -> they do not have same intervals, but the edges do
-        elif track["type"] == "Switch" or side_switch_switch_side:
-            if len(track["aSide"]) > len(track["bSide"]):
-                a = g.add_node(TrackNode(track["name"] + "AR", track["type"]))
-                b = g.add_node(TrackNode(track["name"] + "AL", track["type"]))
-                c = g.add_node(TrackNode(track["name"] + "B", track["type"]))
-                a.opposites.extend([c])
-                b.opposites.extend([c])
-                c.opposites.extend([a, b])
-                nodes_per_id_A[track["id"]] = [track["name"] + "AR", track["name"] + "AL"]
-                nodes_per_id_B[track["id"]] = [track["name"] + "B"]
-            else:
-                a = g.add_node(TrackNode(track["name"] + "A", track["type"]))
-                b = g.add_node(TrackNode(track["name"] + "BR", track["type"]))
-                c = g.add_node(TrackNode(track["name"] + "BL", track["type"]))
-                a.opposites.extend([b, c])
-                b.opposites.extend([a])
-                c.opposites.extend([a])
-                nodes_per_id_A[track["id"]] = [track["name"] + "A"]
-                nodes_per_id_B[track["id"]] = [track["name"] + "BR", track["name"] + "BL"]
-        elif track["type"] == "EnglishSwitch":
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+DELIMITERS = frozenset(" \t\n\r,:]}")
+# Top level lists of a location file that are read one element at a time
+STREAMED_KEYS = {"trackParts", "signals", "stations"}
+# Fields of a track part that are needed to connect it to its neighbours, once all track parts are read
+TrackConnections = namedtuple("TrackConnections", ["id", "name", "type", "length", "aSide", "bSide", "sawMovementAllowed", "wisselhoek"])
+
+def location_path(file):
+    """Location files are looked up relative to this module first, and otherwise relative to the working directory."""
+    file_path = (Path(__file__).parent / file).resolve()
+    if file_path.exists():
+        return file_path
+    return Path(file)
+
+def add_track_nodes(g: TrackGraph, track, nodes_per_id_A, nodes_per_id_B):
+    """Add the nodes of a single track part to the graph, the edges are added once all track parts are known."""
+    side_switch_track_side  = track["type"] == "SideSwitch" and (len(track["aSide"]) == 1 or len(track["bSide"]) == 1)
+    side_switch_switch_side = track["type"] == "SideSwitch" and (len(track["aSide"]) == 2 or len(track["bSide"]) == 2)
+    if track["type"] in {"RailRoad", "Bumper"} or side_switch_track_side:
+        a = g.add_node(TrackNode(track["name"] + "A", track["type"]))
+        b = g.add_node(TrackNode(track["name"] + "B", track["type"]))
+        if track.get("stationPlatform", False):
+            a.stationPlatform = True
+            b.stationPlatform = True
+        # A/B nodes are associated because the have the same interval on the node if train can reverse
+        if track["sawMovementAllowed"]:
+            a.associated.append(b)
+            b.associated.append(a)
+            a.canReverse = True
+            b.canReverse = True
+        # A/B nodes are opposite because they have opposite edges attaches
+        a.opposites.append(b)
+        b.opposites.append(a)
+        nodes_per_id_A[track["id"]] = [track["name"] + "A"]
+        nodes_per_id_B[track["id"]] = [track["name"] + "B"]
+    # Nodes on the same side of a switch are not associated -> they do not have same intervals, but the edges do
+    elif track["type"] == "Switch" or side_switch_switch_side:
+        if len(track["aSide"]) > len(track["bSide"]):
             a = g.add_node(TrackNode(track["name"] + "AR", track["type"]))
             b = g.add_node(TrackNode(track["name"] + "AL", track["type"]))
-            c = g.add_node(TrackNode(track["name"] + "BR", track["type"]))
-            d = g.add_node(TrackNode(track["name"] + "BL", track["type"]))
-            a.opposites.extend([c, d])
-            b.opposites.extend([c, d])
+            c = g.add_node(TrackNode(track["name"] + "B", track["type"]))
+            a.opposites.extend([c])
+            b.opposites.extend([c])
             c.opposites.extend([a, b])
-            d.opposites.extend([a, b])
             nodes_per_id_A[track["id"]] = [track["name"] + "AR", track["name"] + "AL"]
+            nodes_per_id_B[track["id"]] = [track["name"] + "B"]
+        else:
+            a = g.add_node(TrackNode(track["name"] + "A", track["type"]))
+            b = g.add_node(TrackNode(track["name"] + "BR", track["type"]))
+            c = g.add_node(TrackNode(track["name"] + "BL", track["type"]))
+            a.opposites.extend([b, c])
+            b.opposites.extend([a])
+            c.opposites.extend([a])
+            nodes_per_id_A[track["id"]] = [track["name"] + "A"]
             nodes_per_id_B[track["id"]] = [track["name"] + "BR", track["name"] + "BL"]
-    for track in data["trackParts"]:
-        # if track["type"] != "Bumper":
-        aEdges = []
-        bEdges = []
-        bumperAside, bumperBside = True, True
-        for i, aSideId in enumerate(track["aSide"]):
-            fromNode = nodes_per_id_A[track["id"]][i]
-            if aSideId in nodes_per_id_A:
-                bumperAside = False
-                # Connect the aSide node(s) to the respective edges
-                for aSideToTrack in nodes_per_id_A[aSideId]:
-                    length = track_lengths[aSideId]
-                    e = g.add_edge(TrackEdge(g.nodes[fromNode], g.nodes[aSideToTrack], length, track["wisselhoek"]))
-                    aEdges.append(e)
-            # This side is a bumper, it attaches to the other side
-            if g.nodes[fromNode].type == "Bumper" and track["sawMovementAllowed"]:
-                toNode = nodes_per_id_B[track["id"]][i]
-                length = track_lengths[track["id"]]
-                g.add_edge(TrackEdge(g.nodes[toNode], g.nodes[fromNode], length))
-        for i, bSideId in enumerate(track["bSide"]):
-            fromNode = nodes_per_id_B[track["id"]][i]
-            if bSideId in nodes_per_id_B:
-                bumperBside = False
-                # Connect the bSide node(s) to the respective neighbors
-                for bSideToTrack in nodes_per_id_B[bSideId]:
-                    length = track_lengths[bSideId]
-                    e = g.add_edge(TrackEdge(g.nodes[fromNode], g.nodes[bSideToTrack], length, track["wisselhoek"]))
-                    bEdges.append(e)
-            # This side is a bumper, it attaches to the other side
-            if g.nodes[fromNode].type == "Bumper" and track["sawMovementAllowed"]:
-                toNode = nodes_per_id_A[track["id"]][i]
-                length = track_lengths[track["id"]]
-                g.add_edge(TrackEdge(g.nodes[toNode], g.nodes[fromNode], length))
-
-
-        if track["type"] == "SideSwitch":
-            fromNode = None
-            toNodeL = None
-            toNodeR = None
-            if not track["aSide"]:
-                fromNode = g.nodes[track["name"] + "A"]
-                toNodeName = track["name"][0:-3] + track["name"][-2:-4:-1] + "-B"
-                if toNodeName in g.nodes:
-                    toNodeL = g.nodes[toNodeName]
-                else:
-                    toNodeL = g.nodes[toNodeName + "L"]
-                    toNodeR = g.nodes[toNodeName + "R"]
-            if not track["bSide"]:
-                fromNode = g.nodes[track["name"] + "B"]
-                toNodeName = track["name"][0:-3] + track["name"][-2:-4:-1] + "-A"
-                if toNodeName in g.nodes:
-                    toNodeL = g.nodes[toNodeName]
-                else:
-                    toNodeL = g.nodes[toNodeName + "L"]
-                    toNodeR = g.nodes[toNodeName + "R"]
-
-            if fromNode is None:
-                raise ValueError("A and B side populated somehow " + track)
-
-            g.add_edge(TrackEdge(fromNode, toNodeL, 0))
-            if toNodeR is not None:
-                g.add_edge(TrackEdge(fromNode, toNodeR, 0))
-
-
-        # If it is a double-ended (not dead-end) track where parking is allowed, then we can go from A->B and B->A
-        if track["type"] == "RailRoad" and track["sawMovementAllowed"] and not bumperAside and not bumperBside:
-            g.add_edge(TrackEdge(g.nodes[nodes_per_id_A[track["id"]][i]], g.nodes[nodes_per_id_B[track["id"]][i]], 0))
-            g.add_edge(TrackEdge(g.nodes[nodes_per_id_B[track["id"]][i]], g.nodes[nodes_per_id_A[track["id"]][i]], 0))
-        # Assign the associated edges (same side of switch)
-        for x in aEdges:
-            for y in aEdges:
-                if x != y and (x.from_node.name == y.from_node.name or x.to_node.name == y.to_node.name):
-                    x.associated.append(y)
-                    y.associated.append(x)
-        for x in bEdges:
-            for y in bEdges:
-                if x != y and (x.from_node.name == y.from_node.name or x.to_node.name == y.to_node.name):
-                    x.associated.append(y)
-                    y.associated.append(x)
+    elif track["type"] == "EnglishSwitch":
+        a = g.add_node(TrackNode(track["name"] + "AR", track["type"]))
+        b = g.add_node(TrackNode(track["name"] + "AL", track["type"]))
+        c = g.add_node(TrackNode(track["name"] + "BR", track["type"]))
+        d = g.add_node(TrackNode(track["name"] + "BL", track["type"]))
+        a.opposites.extend([c, d])
+        b.opposites.extend([c, d])
+        c.opposites.extend([a, b])
+        d.opposites.extend([a, b])
+        nodes_per_id_A[track["id"]] = [track["name"] + "AR", track["name"] + "AL"]
+        nodes_per_id_B[track["id"]] = [track["name"] + "BR", track["name"] + "BL"]
+
+
+class JsonStreamReader:
+    """Reads JSON values one at a time from a file, keeping only a small part of the file in memory."""
+    def __init__(self, f, chunk_size=1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        # Read at least as much as is still buffered, so a value spanning many chunks is not decoded over and over
+        chunk = self.f.read(max(self.chunk_size, len(self.buffer) - self.pos))
+        if not chunk:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                raise json.JSONDecodeError("Unexpected end of file", self.buffer, self.pos)
+            self._fill()
+
+    def consume(self, char):
+        if self.peek() == char:
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, char):
+        if not self.consume(char):
+            raise json.JSONDecodeError(f"Expecting '{char}'", self.buffer, self.pos)
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number may continue in the next chunk, so a value is only complete once its delimiter is read
+                if self.eof or (end < len(self.buffer) and self.buffer[end] in DELIMITERS):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+
+def iter_location(file_path, streamed_keys=STREAMED_KEYS):
+    """
+    Read the top level object of a location file incrementally, yielding (key, value) pairs. The elements of the lists
+    in streamed_keys are yielded one at a time as (key, element), so these lists are never in memory as a whole.
+    """
+    with open(file_path) as f:
+        reader = JsonStreamReader(f)
+        reader.expect("{")
+        if reader.consume("}"):
+            return
+        while True:
+            key = reader.value()
+            reader.expect(":")
+            if key in streamed_keys and reader.peek() == "[":
+                reader.expect("[")
+                if not reader.consume("]"):
+                    while True:
+                        yield key, reader.value()
+                        if reader.consume("]"):
+                            break
+                        reader.expect(",")
+            else:
+                yield key, reader.value()
+            if reader.consume("}"):
+                return
+            reader.expect(",")
+
+
+def track_connections(track) -> TrackConnections:
+    return TrackConnections(*(track.get(field) for field in TrackConnections._fields))
+
+
+def track_part_nodes(g: TrackGraph, track: TrackConnections) -> tuple[list[str], list[str]]:
+    """Names of the A side and B side nodes of a track part in g, in the order add_track_nodes creates them."""
+    return ([track.name + side for side in ("A", "AR", "AL") if track.name + side in g.nodes],
+            [track.name + side for side in ("B", "BR", "BL") if track.name + side in g.nodes])
+
+
+def connect_track_part(g: TrackGraph, track: TrackConnections, nodes_per_id_A, nodes_per_id_B):
+    """Add the outgoing edges of the nodes of a track part, the nodes of its neighbours must be in the graph already."""
+    aEdges = []
+    bEdges = []
+    bumperAside, bumperBside = True, True
+    for i, aSideId in enumerate(track.aSide):
+        fromNode = nodes_per_id_A[track.id][i]
+        if aSideId in nodes_per_id_A:
+            bumperAside = False
+            # Connect the aSide node(s) to the respective edges
+            for aSideToTrack in nodes_per_id_A[aSideId]:
+                length = g.track_parts[aSideId].length
+                e = g.add_edge(TrackEdge(g.nodes[fromNode], g.nodes[aSideToTrack], length, track.wisselhoek))
+                aEdges.append(e)
+        # This side is a bumper, it attaches to the other side
+        if g.nodes[fromNode].type == "Bumper" and track.sawMovementAllowed:
+            toNode = nodes_per_id_B[track.id][i]
+            length = track.length
+            g.add_edge(TrackEdge(g.nodes[toNode], g.nodes[fromNode], length))
+    for i, bSideId in enumerate(track.bSide):
+        fromNode = nodes_per_id_B[track.id][i]
+        if bSideId in nodes_per_id_B:
+            bumperBside = False
+            # Connect the bSide node(s) to the respective neighbors
+            for bSideToTrack in nodes_per_id_B[bSideId]:
+                length = g.track_parts[bSideId].length
+                e = g.add_edge(TrackEdge(g.nodes[fromNode], g.nodes[bSideToTrack], length, track.wisselhoek))
+                bEdges.append(e)
+        # This side is a bumper, it attaches to the other side
+        if g.nodes[fromNode].type == "Bumper" and track.sawMovementAllowed:
+            toNode = nodes_per_id_A[track.id][i]
+            length = track.length
+            g.add_edge(TrackEdge(g.nodes[toNode], g.nodes[fromNode], length))
+
+
+    if track.type == "SideSwitch":
+        fromNode = None
+        toNodeL = None
+        toNodeR = None
+        if not track.aSide:
+            fromNode = g.nodes[track.name + "A"]
+            toNodeName = track.name[0:-3] + track.name[-2:-4:-1] + "-B"
+            if toNodeName in g.nodes:
+                toNodeL = g.nodes[toNodeName]
+            else:
+                toNodeL = g.nodes[toNodeName + "L"]
+                toNodeR = g.nodes[toNodeName + "R"]
+        if not track.bSide:
+            fromNode = g.nodes[track.name + "B"]
+            toNodeName = track.name[0:-3] + track.name[-2:-4:-1] + "-A"
+            if toNodeName in g.nodes:
+                toNodeL = g.nodes[toNodeName]
+            else:
+                toNodeL = g.nodes[toNodeName + "L"]
+                toNodeR = g.nodes[toNodeName + "R"]
+
+        if fromNode is None:
+            raise ValueError("A and B side populated somehow " + str(track))
+
+        g.add_edge(TrackEdge(fromNode, toNodeL, 0))
+        if toNodeR is not None:
+            g.add_edge(TrackEdge(fromNode, toNodeR, 0))
+
+
+    # If it is a double-ended (not dead-end) track where parking is allowed, then we can go from A->B and B->A
+    if track.type == "RailRoad" and track.sawMovementAllowed and not bumperAside and not bumperBside:
+        g.add_edge(TrackEdge(g.nodes[nodes_per_id_A[track.id][i]], g.nodes[nodes_per_id_B[track.id][i]], 0))
+        g.add_edge(TrackEdge(g.nodes[nodes_per_id_B[track.id][i]], g.nodes[nodes_per_id_A[track.id][i]], 0))
+    # Assign the associated edges (same side of switch)
+    for x in aEdges:
+        for y in aEdges:
+            if x != y and (x.from_node.name == y.from_node.name or x.to_node.name == y.to_node.name):
+                x.associated.append(y)
+                y.associated.append(x)
+    for x in bEdges:
+        for y in bEdges:
+            if x != y and (x.from_node.name == y.from_node.name or x.to_node.name == y.to_node.name):
+                x.associated.append(y)
+                y.associated.append(x)
+
+
+def opposite_edges(e: TrackEdge) -> list[TrackEdge]:
+    """The edges between the opposite nodes of the end nodes of e, collected from both end nodes in node order."""
+    from_side = [other_edge for opposite_node in e.from_node.opposites for other_edge in opposite_node.incoming
+                 if other_edge.from_node in e.to_node.opposites]
+    to_side = [other_edge for opposite_node in e.to_node.opposites for other_edge in opposite_node.outgoing
+               if other_edge.to_node in e.from_node.opposites]
+    if e.from_node.index <= e.to_node.index:
+        return from_side + to_side
+    return to_side + from_side
+
+
+@profiled("read_graph")
+def read_graph(file, compact=False) -> TrackGraph:
+    g = TrackGraph(file)
+    nodes_per_id_A = {}
+    nodes_per_id_B = {}
+    signals = []
+    stations = []
+    distance_markers = None
+    # Nodes are added while the track parts are read, only the fields needed for the edges are kept until all are read
+    for key, value in iter_location(location_path(file)):
+        if key == "trackParts":
+            add_track_nodes(g, value, nodes_per_id_A, nodes_per_id_B)
+            g.track_parts[value["id"]] = track_connections(value)
+        elif key == "signals":
+            signals.append((value["name"], value["side"], value["track"]))
+        elif key == "stations":
+            stations.append((value["stationName"], value["platform"], value["trackId"]))
+        elif key == "distanceMarkers":
+            distance_markers = value
+    for track in g.track_parts.values():
+        connect_track_part(g, track, nodes_per_id_A, nodes_per_id_B)
 
     # Assign the opposite edges (opposite direction)
-    for node in g.nodes:
-        for e in g.nodes[node].outgoing:
-            for opposite_node in g.nodes[node].opposites:
-                for other_edge in g.nodes[opposite_node.name].incoming:
-                    if other_edge.from_node in e.to_node.opposites:
-                        e.opposites.append(other_edge)
-        for e in g.nodes[node].incoming:
-            for opposite_node in g.nodes[node].opposites:
-                for other_edge in g.nodes[opposite_node.name].outgoing:
-                    if other_edge.to_node in e.from_node.opposites:
-                        e.opposites.append(other_edge)
-
-    g.distance_markers = data["distanceMarkers"] if "distanceMarkers" in data and data["distanceMarkers"] else {"Start": 0}
+    # A node has at most two opposites and at most two edges per side (switches), so this is linear in the track parts
+    for e in g.edges:
+        e.opposites = opposite_edges(e)
+
+    g.distance_markers = distance_markers if distance_markers else {"Start": 0}
     min_distance = min(g.distance_markers.values())
     for key, val in g.distance_markers.items():
         g.distance_markers[key] = val - min_distance
 
     # Extract signal locations
-    signals = data["signals"] if "signals" in data else []
-    for signal in signals:
-        if signal["side"] == "A":
-            track = g.nodes[nodes_per_id_A[signal["track"]][0]]
+    for name, side, track_id in signals:
+        if side == "A":
+            track = g.nodes[nodes_per_id_A[track_id][0]]
         else:
-            track = g.nodes[nodes_per_id_B[signal["track"]][0]]
-        g.add_signal(Signal(signal["name"], track))
+            track = g.nodes[nodes_per_id_B[track_id][0]]
+        g.add_signal(Signal(name, track))
 
 
-    stations = data["stations"] if "stations" in data else []
-    for station in stations:
-        if len(nodes_per_id_A[station["trackId"]]) != 1 or len(nodes_per_id_B[station["trackId"]]) != 1:
-            logger.error(f'Found platform {station["stationName"].upper()}|{station["platform"]} on a switch: A: {nodes_per_id_A[station["trackId"]]} or B: {nodes_per_id_B[station["trackId"]]}')
-        g.stations[f"{station['stationName'].upper()}|{station['platform']}"] = (nodes_per_id_A[station["trackId"]][0], nodes_per_id_B[station["trackId"]][0])
+    for station_name, platform, track_id in stations:
+        if len(nodes_per_id_A[track_id]) != 1 or len(nodes_per_id_B[track_id]) != 1:
+            logger.error(f'Found platform {station_name.upper()}|{platform} on a switch: A: {nodes_per_id_A[track_id]} or B: {nodes_per_id_B[track_id]}')
+        g.stations[f"{station_name.upper()}|{platform}"] = (nodes_per_id_A[track_id][0], nodes_per_id_B[track_id][0])
+    if compact:
+        g.compact()
     return g
 
 